@@ -0,0 +1,114 @@
+"""
+Measures the cold start cost of the lambda handlers.
+
+Every run starts a fresh interpreter with `-X importtime`, imports the handler module
+and answers a prewarm and an invalid webhook event with `github_handler`, the paths that
+should never load heavy clients. Medians over all runs are printed, and appended as a json
+line per commit to the output file if one is given. The bench fails if either path loaded
+one of the heavy modules::
+
+    python bench/startup.py --runs 20 --output /tmp/spillguard-startup.jsonl
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+HEAVY_MODULES = ('boto3', 'botocore', 'requests', 'raven', 'raven_python_lambda', 'ssl')
+
+CHILD = '''
+import sys, time, json
+start = time.perf_counter()
+from scumblr_spillguard import handler
+imported = time.perf_counter()
+handler.github_handler({'source': 'aws.events'}, None)
+prewarmed = time.perf_counter()
+loaded = [m for m in %r if m in sys.modules]
+response = handler.github_handler({'resource': '/github', 'headers': {}, 'requestContext': {'identity': {'userAgent': 'curl'}}}, None)
+assert response['statusCode'] == '403', response
+rejected = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'prewarm_ms': (prewarmed - imported) * 1000,
+    'invalid_ms': (rejected - prewarmed) * 1000,
+    'prewarm_loaded': loaded,
+    'invalid_loaded': [m for m in %r if m in sys.modules and m not in loaded],
+}))
+''' % (HEAVY_MODULES, HEAVY_MODULES)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_importtime(stderr):
+    """Return the cumulative import time in microseconds of each top level module."""
+    modules = {}
+
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            modules[name.strip()] = int(cumulative)
+
+    return modules
+
+
+def run_once():
+    env = dict(os.environ, LOG_LEVEL='WARNING', PYTHONPATH=ROOT)
+    env.pop('PREFETCH_SECRETS', None)
+
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', CHILD],
+        cwd=ROOT, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True
+    )
+
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    result['importtime_us'] = parse_importtime(process.stderr).get('scumblr_spillguard.handler')
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--output', help='file the result is appended to')
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.runs)]
+
+    report = {
+        'commit': git_commit(),
+        'time': int(time.time()),
+        'python': sys.version.split()[0],
+        'runs': args.runs,
+    }
+
+    for key in ('importtime_us', 'import_ms', 'prewarm_ms', 'invalid_ms'):
+        report[key] = round(statistics.median(r[key] for r in runs), 3)
+
+    report['prewarm_loaded'] = runs[-1]['prewarm_loaded']
+    report['invalid_loaded'] = runs[-1]['invalid_loaded']
+
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(report, sort_keys=True) + '\n')
+
+    loaded = set(r for run in runs for r in run['prewarm_loaded'] + run['invalid_loaded'])
+    if loaded:
+        sys.exit('heavy modules loaded on the prewarm or invalid path: {}'.format(', '.join(sorted(loaded))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+"""
+Scans the history of a local git clone or mirror for scumblr terms.
+
+Blobs are read straight from the object store with `git cat-file --batch`, so no github
+api quota is spent. Every unique blob is scanned once, by a pool of processes, with the
+scanner the lambda handlers use. Progress is checkpointed so an interrupted backfill
+resumes where it stopped::
+
+    spillguard-backfill /srv/mirrors/repo.git --url https://github.com/org/repo \\
+        --terms configs.json --checkpoint repo.checkpoint --output results.json
+
+Results are written in the format `process_task_configs` sends to scumblr.
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from scumblr_spillguard import log
+
+# blobs handed to a worker process at a time
+BATCH_SIZE = int(os.environ.get('BACKFILL_BATCH_SIZE', 256))
+# blobs larger than this many bytes are not scanned
+MAX_BLOB_SIZE = int(os.environ.get('BACKFILL_MAX_BLOB_SIZE', 50 * 1024 * 1024))
+
+NULL_SHA = '0' * 40
+SUBMODULE_MODE = '160000'
+
+_worker = {}
+
+
+def iter_blob_commits(repo):
+    """Yield (blob sha, commit) for every blob added or modified by a commit on any ref."""
+    process = subprocess.Popen(
+        ['git', '-C', repo, '-c', 'core.quotepath=off', 'log', '--all', '--raw', '--no-abbrev',
+         '--no-renames', '--format=commit %H%x09%S%x09%cn%x09%ce'],
+        stdout=subprocess.PIPE
+    )
+
+    commit = None
+
+    for line in process.stdout:
+        line = line.decode('utf-8', 'replace').rstrip('\n')
+
+        if line.startswith('commit '):
+            sha, ref, name, email = line[len('commit '):].split('\t')
+            commit = {'sha': sha, 'ref': ref, 'committer': {'name': name, 'email': email}}
+        elif line.startswith(':') and commit:
+            meta, path = line[1:].split('\t', 1)
+            _, mode, _, blob, status = meta.split()
+
+            if status.startswith('D') or blob == NULL_SHA or mode == SUBMODULE_MODE:
+                continue
+
+            yield blob, dict(commit, path=path)
+
+    if process.wait():
+        raise RuntimeError('git log failed. Repository: {0}'.format(repo))
+
+
+class CatFile(object):
+    """Reads objects through a long running `git cat-file --batch` process."""
+    def __init__(self, repo):
+        self.process = subprocess.Popen(
+            ['git', '-C', repo, 'cat-file', '--batch'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def read(self, sha, max_size=MAX_BLOB_SIZE):
+        """Return the contents of a blob, or None if it is missing or larger than max_size."""
+        self.process.stdin.write(sha.encode('ascii') + b'\n')
+        self.process.stdin.flush()
+
+        header = self.process.stdout.readline().decode('ascii').split()
+        if len(header) < 3 or header[1] != 'blob':
+            return None
+
+        size = int(header[2])
+        if size > max_size:
+            # the contents still have to be consumed to keep the stream in step
+            remaining = size + 1
+            while remaining:
+                remaining -= len(self.process.stdout.read(min(remaining, 1024 * 1024)))
+            return None
+
+        contents = self.process.stdout.read(size)
+        self.process.stdout.read(1)
+        return contents
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+def get_worker(repo, configs):
+    """Return the scanner and object reader of this worker process, set up on its first batch."""
+    from scumblr_spillguard.scanner import get_scanner, task_terms
+
+    if _worker.get('repo') != repo:
+        if _worker.get('cat_file'):
+            _worker['cat_file'].close()
+        _worker['repo'] = repo
+        _worker['cat_file'] = CatFile(repo)
+
+    return get_scanner(task_terms(configs)), _worker['cat_file']
+
+
+def scan_batch(repo, configs, shas):
+    """Scan a batch of blobs in a worker process, returning (sha, hits) for each."""
+    from scumblr_spillguard import blobs
+
+    scanner, cat_file = get_worker(repo, configs)
+    scanned = []
+
+    for sha in shas:
+        contents = cat_file.read(sha)
+        hits = []
+
+        if contents is not None:
+            hits = blobs.scan_bytes(scanner, contents)
+
+        scanned.append((sha, [list(k) for k in hits]))
+
+    return scanned
+
+
+def load_checkpoint(path, terms_hash):
+    """Return the blobs already scanned and their hits from a checkpoint file."""
+    done, hits = set(), {}
+
+    if not path or not os.path.exists(path):
+        return done, hits
+
+    with open(path) as f:
+        for i, line in enumerate(f):
+            entry = json.loads(line)
+
+            if i == 0:
+                if entry.get('terms_hash') != terms_hash:
+                    raise ValueError('Checkpoint was written for a different term set. Checkpoint: {0}'.format(path))
+                continue
+
+            done.update(entry['scanned'])
+            hits.update(entry['hits'])
+
+    return done, hits
+
+
+def scan_repository(repo, configs, checkpoint=None, workers=None, batch_size=BATCH_SIZE):
+    """Scan every unique blob of a repository, returning the blob index and the hits of each blob."""
+    from scumblr_spillguard.scanner import get_task_scanner
+
+    terms_hash = get_task_scanner(configs).hash
+    done, hits = load_checkpoint(checkpoint, terms_hash)
+
+    index = OrderedDict()
+    for blob, commit in iter_blob_commits(repo):
+        index.setdefault(blob, []).append(commit)
+
+    pending = [sha for sha in index if sha not in done]
+    log.info('Backfilling repository. Repository: {0} Blobs: {1} Remaining: {2}'.format(
+        repo, len(index), len(pending)))
+
+    if not pending:
+        return index, hits
+
+    out = None
+    if checkpoint:
+        new = not os.path.exists(checkpoint)
+        out = open(checkpoint, 'a')
+        if new:
+            out.write(json.dumps({'terms_hash': terms_hash}) + '\n')
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(scan_batch, repo, configs, pending[i:i + batch_size])
+                       for i in range(0, len(pending), batch_size)]
+
+            for future in as_completed(futures):
+                scanned = future.result()
+                batch_hits = dict((sha, keys) for sha, keys in scanned if keys)
+                hits.update(batch_hits)
+
+                if out:
+                    out.write(json.dumps({'scanned': [sha for sha, _ in scanned], 'hits': batch_hits}) + '\n')
+                    out.flush()
+    finally:
+        if out:
+            out.close()
+
+    return index, hits
+
+
+def build_results(index, hits, configs, url=None):
+    """Turn blob hits into scumblr results, attributed to every commit that introduced the blob."""
+    from scumblr_spillguard import filters
+    from scumblr_spillguard.handler import process_task_configs
+
+    file_filters = filters.get_filters(configs)
+    results = {}
+
+    for sha, keys in hits.items():
+        for commit in index.get(sha, []):
+            tasks = filters.wanted_tasks(file_filters, {'filename': commit['path']})
+            if not tasks:
+                continue
+
+            contents_url = commit['path']
+            if url:
+                contents_url = '{0}/blob/{1}/{2}'.format(url.rstrip('/'), commit['sha'], commit['path'])
+
+            process_task_configs({
+                'sha': commit['sha'],
+                'ref': commit['ref'],
+                'committer': commit['committer'],
+                'html_url': url or '',
+                'contents_url': contents_url,
+                'blob_sha': sha,
+                'blob_hits': [tuple(k) for k in keys],
+                'tasks': tasks,
+                'patch_contents': None
+            }, configs, results)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('repo', help='path to a local clone or mirror')
+    parser.add_argument('--url', help='repository url used for the html and content urls of findings')
+    parser.add_argument('--terms', help='json scumblr task configs, defaults to the live scumblr config')
+    parser.add_argument('--checkpoint', help='file progress is saved to and resumed from')
+    parser.add_argument('--workers', type=int, help='number of scanning processes, defaults to the cpu count')
+    parser.add_argument('--output', help='file the results are written to, defaults to stdout')
+    parser.add_argument('--send', action='store_true', help='send the results to scumblr')
+    args = parser.parse_args(argv)
+
+    if args.terms:
+        with open(args.terms) as f:
+            configs = json.load(f)
+    else:
+        from scumblr_spillguard import scumblr
+        configs = scumblr.get_config('GithubEventAnalyzer')
+
+    index, hits = scan_repository(args.repo, configs, args.checkpoint, args.workers)
+    results = build_results(index, hits, configs, args.url)
+
+    output = json.dumps(list(results.values()), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.send and results:
+        from scumblr_spillguard.handler import send_task_results
+        send_task_results(results)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,17 @@
 import os
 import json
-import requests
-from retrying import retry
+import logging
 
-from scumblr_spillguard import log
+from scumblr_spillguard import log, metrics
 from scumblr_spillguard.secrets import get_secret
+from scumblr_spillguard.sessions import get_session
 from scumblr_spillguard.exceptions import GeneralFailure
 
+# number of items requested per page from paged apis
+PAGE_LIMIT = int(os.environ.get('BITBUCKET_PAGE_LIMIT', 1000))
+# bytes read at a time from the raw file endpoint
+RAW_CHUNK_SIZE = 64 * 1024
+
 
 def get_rest_url(url):
     """Breaks the base url of the event and reassembles them into a base rest url."""
@@ -24,6 +29,11 @@ def reconstruct_contents(lines):
     return '\n'.join([l['text'] for l in lines['lines']])
 
 
+def get_raw_url(file_url):
+    """Turns a browse file url into the url of the raw file endpoint."""
+    return file_url.replace('/browse/', '/raw/', 1)
+
+
 def get_file_url(url):
     """Formats the file URL into something we can actually fetch."""
     parts = url.split('/')[:-2]
@@ -36,22 +46,71 @@ def get_file_url(url):
     return url
 
 
-def request(url):
+def get_auth():
+    return os.environ['BITBUCKET_USER'], get_secret('ENCRYPTED_BITBUCKET_PASSWORD').decode('utf-8')
+
+
+def iter_pages(url, limit=PAGE_LIMIT):
+    """Yield every page of a paged stash api, following `nextPageStart` until `isLastPage`."""
+    start = 0
+
+    while True:
+        page = request(url, params={'start': start, 'limit': limit})
+        yield page
+
+        if page.get('isLastPage', True) or page.get('nextPageStart') is None:
+            break
+        start = page['nextPageStart']
+
+
+def get_changes(url):
+    """Return all changes of a commit, across pages."""
+    return [change for page in iter_pages(url) for change in page['values']]
+
+
+def stream_contents(file_url):
+    """Yield the contents of a file in chunks.
+
+    The raw endpoint is streamed as bytes when the server has one, otherwise the pages
+    of the browse api are yielded one at a time as text.
+    """
+    url = get_rest_url(get_raw_url(file_url))
+    log.debug('Bitbucket Request. Url: {}'.format(url))
+
+    response = get_session(url).get(url, auth=get_auth(), stream=True)
+
+    if response.ok:
+        for chunk in response.iter_content(RAW_CHUNK_SIZE):
+            metrics.incr('BitbucketBytes', len(chunk))
+            yield chunk
+        return
+
+    response.close()
+    log.debug('No raw endpoint, browsing instead. Status: {0}'.format(response.status_code))
+
+    for i, page in enumerate(iter_pages(file_url)):
+        yield ('\n' if i else '') + reconstruct_contents(page)
+
+
+def request(url, params=None):
     """Attempt to make a stash request."""
-    user = os.environ['BITBUCKET_USER']
-    password = get_secret('ENCRYPTED_BITBUCKET_PASSWORD').decode('utf-8')
+    user, password = get_auth()
 
     url = get_rest_url(url)
 
     log.debug('Bitbucket Request. Url: {} User: {}'.format(url, user))
-    response = requests.get(url, auth=(user, password))
+    response = get_session(url).get(url, auth=(user, password), params=params)
 
     if not response.ok:
         raise GeneralFailure('Request to Bitbucket failed. URL: {0}'.format(url))
 
-    log.debug('Bitbucket Response. Status: {0} Data: {1}'.format(
-        response.status_code,
-        json.dumps(response.json(), indent=2)
-    ))
+    data = response.json()
+    metrics.incr('BitbucketBytes', len(response.content))
+
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('Bitbucket Response. Status: {0} Data: {1}'.format(
+            response.status_code,
+            json.dumps(data, indent=2)
+        ))
 
-    return response.json()
+    return data
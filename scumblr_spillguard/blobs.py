@@ -0,0 +1,251 @@
+import os
+import base64
+import codecs
+
+from scumblr_spillguard import log, metrics
+
+# blobs larger than this are read, or decoded, and scanned in chunks
+STREAM_THRESHOLD = int(os.environ.get('BLOB_STREAM_THRESHOLD', 1024 * 1024))
+# size of the raw chunks read, or of the encoded slices decoded, at a time
+CHUNK_SIZE = int(os.environ.get('BLOB_CHUNK_SIZE', 1024 * 1024))
+# characters shared between consecutive chunks, the longest regex match guaranteed to be found
+SCAN_OVERLAP = int(os.environ.get('BLOB_SCAN_OVERLAP', 4096))
+# what to do with binary blobs: run a cheaper 'literal' only scan or 'skip' them
+BINARY_MODE = os.environ.get('BLOB_BINARY_MODE', 'literal')
+
+SNIFF_SIZE = 8000
+
+# only signatures long or unusual enough that no text file starts with them
+MAGIC_NUMBERS = (
+    b'\x89PNG\r\n\x1a\n', b'GIF87a', b'GIF89a', b'\xff\xd8\xff', b'PK\x03\x04', b'\x1f\x8b\x08',
+    b'\x7fELF', b'\xca\xfe\xba\xbe', b'\xfe\xed\xfa\xce', b'\xfe\xed\xfa\xcf', b'\xce\xfa\xed\xfe',
+    b'\xcf\xfa\xed\xfe', b'7z\xbc\xaf\x27\x1c'
+)
+
+
+def utf16_encoding(head):
+    """Return the utf-16 flavour of text that starts with head, or None if it isn't utf-16."""
+    if head.startswith((b'\xff\xfe', b'\xfe\xff')):
+        return 'utf-16'
+
+    sample = head[:512]
+    if len(sample) < 8:
+        return None
+
+    # mostly ascii, so every other byte is a NUL
+    if sample[1::2].count(0) > len(sample) * 0.45 and not sample[0::2].count(0):
+        return 'utf-16-le'
+    if sample[0::2].count(0) > len(sample) * 0.45 and not sample[1::2].count(0):
+        return 'utf-16-be'
+
+    return None
+
+
+def is_binary(head):
+    """Determine from the first bytes of a file if it is binary, utf-16 text is not."""
+    if utf16_encoding(head):
+        return False
+    return b'\x00' in head[:SNIFF_SIZE] or head.startswith(MAGIC_NUMBERS)
+
+
+class Blob(object):
+    """Base64 encoded file content as returned by the github blob api.
+
+    Content is decoded lazily, either at once for small blobs or in chunks for large
+    ones so that only one decoded chunk is held in memory at a time.
+    """
+    def __init__(self, data, size=None, chunk_size=CHUNK_SIZE):
+        self.data = data
+        self.size = size
+        self.chunk_size = chunk_size
+        self._head = None
+
+    def __len__(self):
+        return len(self.data)
+
+    def chunks(self):
+        """Yield the decoded content in chunks."""
+        carry = ''
+
+        for i in range(0, len(self.data), self.chunk_size):
+            encoded = carry + self.data[i:i + self.chunk_size].replace('\n', '')
+            cut = len(encoded) - len(encoded) % 4
+            carry = encoded[cut:]
+
+            if cut:
+                with metrics.timer('Decode'):
+                    decoded = base64.b64decode(encoded[:cut])
+                yield decoded
+
+        if carry:
+            with metrics.timer('Decode'):
+                decoded = base64.b64decode(carry)
+            yield decoded
+
+    def text_chunks(self, encoding='utf-8'):
+        """Yield the decoded content as text, keeping multi byte characters split across chunks intact.
+
+        Scanning works on bytes, this is the fallback for text that isn't utf-8, e.g. utf-16.
+        """
+        decoder = codecs.getincrementaldecoder(encoding)('ignore')
+
+        for chunk in self.chunks():
+            yield decoder.decode(chunk)
+
+        yield decoder.decode(b'', final=True)
+
+    def decoded(self):
+        """The decoded content as bytes."""
+        with metrics.timer('Decode'):
+            return base64.b64decode(self.data)
+
+    def text(self):
+        return self.decoded().decode('utf-8', 'ignore')
+
+    @property
+    def head(self):
+        """The first decoded bytes of the blob."""
+        if self._head is None:
+            encoded = self.data[:SNIFF_SIZE * 2].replace('\n', '')
+            encoded = encoded[:len(encoded) - len(encoded) % 4]
+            self._head = base64.b64decode(encoded)[:SNIFF_SIZE]
+        return self._head
+
+    @property
+    def binary(self):
+        return is_binary(self.head)
+
+
+class RawBlob(object):
+    """File content streamed from the github blob api's raw media type.
+
+    Opening the blob only reads the response headers, which tell its size. The content
+    is read in chunks as it is scanned, so one chunk is held in memory at a time.
+    `open_response` returns a streamed response of the content, it is called again if
+    the blob is read more than once.
+    """
+    def __init__(self, open_response, size=None, chunk_size=CHUNK_SIZE):
+        self.open_response = open_response
+        self.chunk_size = chunk_size
+        self._open()
+
+        if size is None and 'Content-Length' in self._response.headers:
+            size = int(self._response.headers['Content-Length'])
+        self.size = size
+        self._head = None
+
+    def __len__(self):
+        # content of unknown size is assumed to be large, so it is streamed
+        return self.size if self.size is not None else STREAM_THRESHOLD + 1
+
+    def _open(self):
+        self._response = self.open_response()
+        self._chunks = self._response.iter_content(self.chunk_size)
+        self._first = None
+
+    def peek(self):
+        """Read the first chunk, unless it was already, and return the first bytes of the blob."""
+        if self._head is None:
+            if self._chunks is None:
+                self._open()
+            self._first = next(self._chunks, b'')
+            self._head = self._first[:SNIFF_SIZE]
+        return self._head
+
+    def chunks(self):
+        """Yield the content in chunks."""
+        if self._chunks is None:
+            self._open()
+
+        chunks, first, self._chunks, self._first = self._chunks, self._first, None, None
+
+        try:
+            if first:
+                metrics.incr('BlobBytes', len(first))
+                yield first
+
+            for chunk in chunks:
+                metrics.incr('BlobBytes', len(chunk))
+                yield chunk
+        finally:
+            self.close()
+
+    def text_chunks(self, encoding='utf-8'):
+        """Yield the content as text, keeping multi byte characters split across chunks intact."""
+        decoder = codecs.getincrementaldecoder(encoding)('ignore')
+
+        for chunk in self.chunks():
+            yield decoder.decode(chunk)
+
+        yield decoder.decode(b'', final=True)
+
+    def decoded(self):
+        """The content as bytes."""
+        return b''.join(self.chunks())
+
+    def text(self):
+        return self.decoded().decode('utf-8', 'ignore')
+
+    def close(self):
+        """Release the connection of a blob that isn't read to the end."""
+        if self._response is not None:
+            self._response.close()
+            self._response = self._chunks = self._first = None
+
+    @property
+    def head(self):
+        """The first bytes of the blob."""
+        return self.peek()
+
+    @property
+    def binary(self):
+        return is_binary(self.head)
+
+
+def skip_binary(size):
+    """Record a binary blob that is not scanned."""
+    log.info('Skipping binary blob. Size: {0}'.format(size))
+    metrics.incr('SkippedBinaryBlobs')
+
+
+def scan(scanner, blob):
+    """Scan a blob's raw bytes, streaming large ones and skipping or only literal scanning binary ones.
+
+    Content is never decoded to text, so invalid utf-8 next to a match can't hide it. Utf-16
+    text is the exception, it is decoded as its patterns would never match otherwise.
+    """
+    encoding = utf16_encoding(blob.head)
+    if encoding:
+        return scanner.scan_chunks(blob.text_chunks(encoding), overlap=SCAN_OVERLAP)
+
+    if blob.binary:
+        if BINARY_MODE != 'literal':
+            skip_binary(blob.size)
+            return []
+
+        metrics.incr('BinaryBlobs')
+        return scanner.scan_chunks(blob.chunks(), overlap=0, literals_only=True)
+
+    if len(blob) <= STREAM_THRESHOLD:
+        return scanner.scan(blob.decoded())
+
+    return scanner.scan_chunks(blob.chunks(), overlap=SCAN_OVERLAP)
+
+
+def scan_bytes(scanner, contents):
+    """Scan decoded contents held in memory the way `scan` scans a blob."""
+    head = contents[:SNIFF_SIZE]
+
+    encoding = utf16_encoding(head)
+    if encoding:
+        return scanner.scan(contents.decode(encoding, 'ignore'))
+
+    if is_binary(head):
+        if BINARY_MODE != 'literal':
+            skip_binary(len(contents))
+            return []
+
+        metrics.incr('BinaryBlobs')
+        return scanner.keys_for(scanner.match(contents, literals_only=True))
+
+    return scanner.scan(contents)
@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from scumblr_spillguard import log, metrics
+
+# number of blob results kept in memory by a warm container
+BLOB_CACHE_SIZE = int(os.environ.get('BLOB_CACHE_SIZE', 10000))
+# optional sqlite database used as a persistent second tier
+BLOB_CACHE_PATH = os.environ.get('BLOB_CACHE_PATH')
+
+
+class MemoryStore(object):
+    """A bounded, least recently used in-memory store."""
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+class SQLiteStore(object):
+    """A persistent key value store backed by a local sqlite database."""
+    def __init__(self, path, table='cache'):
+        self.table = table
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS {0} (key TEXT PRIMARY KEY, value TEXT)'.format(table))
+        self.conn.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM {0} WHERE key = ?'.format(self.table), (key,)).fetchone()
+        if row:
+            return json.loads(row[0])
+
+    def set(self, key, value):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO {0} (key, value) VALUES (?, ?)'.format(self.table),
+                (key, json.dumps(value))
+            )
+            self.conn.commit()
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM {0}'.format(self.table))
+            self.conn.commit()
+
+
+class DynamoDBStore(object):
+    """A key value store backed by a DynamoDB table with a `key` hash key.
+
+    Point endpoint_url at DynamoDB Local to run without AWS. Items are written with a
+    `ttl` attribute so the table's time to live can expire them.
+    """
+    def __init__(self, table, endpoint_url=None, ttl=None):
+        import boto3
+        self.ttl = ttl
+        self.table = boto3.session.Session().resource('dynamodb', endpoint_url=endpoint_url).Table(table)
+
+    def get(self, key):
+        item = self.table.get_item(Key={'key': key}).get('Item')
+        if item and (not item.get('ttl') or item['ttl'] > time.time()):
+            return json.loads(item['value'])
+
+    def set(self, key, value):
+        item = {'key': key, 'value': json.dumps(value)}
+        if self.ttl:
+            item['ttl'] = int(time.time() + self.ttl)
+        self.table.put_item(Item=item)
+
+    def clear(self):
+        """Delete every item, scanning the table page by page."""
+        kwargs = {'ProjectionExpression': '#k', 'ExpressionAttributeNames': {'#k': 'key'}}
+
+        with self.table.batch_writer() as batch:
+            while True:
+                page = self.table.scan(**kwargs)
+                for item in page.get('Items', []):
+                    batch.delete_item(Key={'key': item['key']})
+
+                if 'LastEvaluatedKey' not in page:
+                    break
+                kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+class BlobCache(object):
+    """Caches scan results keyed by blob sha and the hash of the term set they were scanned with.
+
+    Results are kept in an in-memory tier and, if configured, a persistent tier that
+    survives container recycling.
+    """
+    def __init__(self, size=BLOB_CACHE_SIZE, store=None):
+        self.memory = MemoryStore(size)
+        self.store = store
+        self.stats = {'hits': 0, 'misses': 0}
+
+    @staticmethod
+    def key(sha, terms_hash):
+        return '{0}:{1}'.format(sha, terms_hash)
+
+    def get(self, sha, terms_hash):
+        """Return the cached hits for a blob, or None if it has not been scanned with these terms."""
+        key = self.key(sha, terms_hash)
+        hits = self.memory.get(key)
+
+        if hits is None and self.store is not None:
+            try:
+                hits = self.store.get(key)
+            except Exception as e:
+                log.exception(e)
+
+            if hits is not None:
+                hits = [tuple(h) for h in hits]
+                self.memory.set(key, hits)
+
+        if hits is None:
+            self.stats['misses'] += 1
+            metrics.incr('BlobCacheMisses')
+        else:
+            self.stats['hits'] += 1
+            metrics.incr('BlobCacheHits')
+
+        return hits
+
+    def set(self, sha, terms_hash, hits):
+        """Remember the hits for a blob scanned with the given term set."""
+        key = self.key(sha, terms_hash)
+        self.memory.set(key, hits)
+
+        if self.store is not None:
+            try:
+                self.store.set(key, hits)
+            except Exception as e:
+                log.exception(e)
+
+    def clear(self):
+        self.memory.clear()
+        if self.store is not None:
+            self.store.clear()
+
+
+blob_cache = BlobCache(store=SQLiteStore(BLOB_CACHE_PATH, 'blobs') if BLOB_CACHE_PATH else None)
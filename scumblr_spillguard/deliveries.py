@@ -0,0 +1,126 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+
+from scumblr_spillguard import log
+from scumblr_spillguard.exceptions import GeneralFailure
+from scumblr_spillguard.cache import MemoryStore, SQLiteStore, DynamoDBStore
+
+# where processed deliveries and commits are remembered: 'memory', 'sqlite' or 'dynamodb'
+DEDUPE_STORE = os.environ.get('SPILLGUARD_DEDUPE_STORE', 'memory')
+DEDUPE_PATH = os.environ.get('SPILLGUARD_DEDUPE_PATH', '/tmp/spillguard-dedupe.db')
+DEDUPE_TABLE = os.environ.get('SPILLGUARD_DEDUPE_TABLE', 'spillguard-dedupe')
+DEDUPE_ENDPOINT = os.environ.get('SPILLGUARD_DEDUPE_ENDPOINT')
+# seconds a delivery or commit is remembered for
+DEDUPE_TTL = int(os.environ.get('SPILLGUARD_DEDUPE_TTL', 7 * 24 * 3600))
+DEDUPE_SIZE = 50000
+
+stats = {'duplicate_deliveries': 0, 'duplicate_commits': 0}
+
+_store = None
+
+
+def get_store():
+    """Return the configured dedupe store."""
+    global _store
+
+    if _store is None:
+        if DEDUPE_STORE == 'dynamodb':
+            _store = DynamoDBStore(DEDUPE_TABLE, endpoint_url=DEDUPE_ENDPOINT, ttl=DEDUPE_TTL)
+        elif DEDUPE_STORE == 'sqlite':
+            _store = SQLiteStore(DEDUPE_PATH, 'dedupe')
+        else:
+            _store = MemoryStore(DEDUPE_SIZE)
+
+    return _store
+
+
+def seen(key):
+    """Determine if work identified by key has already been done."""
+    try:
+        done = get_store().get(key)
+    except Exception as e:
+        log.exception(e)
+        return False
+
+    return done is not None and done + DEDUPE_TTL > time.time()
+
+
+def mark(key):
+    """Remember that work identified by key has been done."""
+    try:
+        get_store().set(key, time.time())
+    except Exception as e:
+        log.exception(e)
+
+
+def delivery_key(delivery):
+    return 'delivery:{0}'.format(delivery)
+
+
+def commit_key(repository, sha, terms_hash):
+    return 'commit:{0}:{1}:{2}'.format(repository, sha, terms_hash)
+
+
+def sent_key(task_id, sha, url, hits):
+    """Key of a finding sent to scumblr, the hits are part of it so new hits are still sent."""
+    hits_hash = hashlib.sha1(json.dumps(sorted(hits)).encode('utf-8')).hexdigest()
+    return 'sent:{0}:{1}:{2}:{3}'.format(task_id, sha, url, hits_hash)
+
+
+def seen_delivery(delivery):
+    """Determine if a github delivery, by its `X-GitHub-Delivery` id, has been processed."""
+    if delivery and seen(delivery_key(delivery)):
+        log.info('Skipping duplicate delivery. Delivery: {0}'.format(delivery))
+        stats['duplicate_deliveries'] += 1
+        return True
+
+    return False
+
+
+def new_commits(repository, commits, terms_hash):
+    """Return the commits that have not been scanned for this repository with this term set."""
+    fresh = []
+
+    for c in commits:
+        if seen(commit_key(repository, c['id'], terms_hash)):
+            log.debug('Skipping duplicate commit. Repository: {0} Commit: {1}'.format(repository, c['id']))
+            stats['duplicate_commits'] += 1
+        else:
+            fresh.append(c)
+
+    return fresh
+
+
+def mark_processed(repository, commits, terms_hash, delivery=None):
+    """Remember a processed delivery and its commits."""
+    for c in commits:
+        mark(commit_key(repository, c['id'], terms_hash))
+
+    if delivery:
+        mark(delivery_key(delivery))
+
+
+def save_checkpoint(value):
+    """Store a value too large to pass along in a message, returning the key it is stored under.
+
+    The value has to outlive this container, so a shared 'sqlite' or 'dynamodb' store is
+    required, with a 'memory' store it would be lost once the work moves to another container.
+    """
+    if isinstance(get_store(), MemoryStore):
+        raise GeneralFailure(
+            'Unable to checkpoint, SPILLGUARD_DEDUPE_STORE must be sqlite or dynamodb to continue large pushes.')
+
+    key = 'checkpoint:{0}'.format(uuid.uuid4().hex)
+    get_store().set(key, value)
+    return key
+
+
+def load_checkpoint(key):
+    """Return a value stored by `save_checkpoint`."""
+    value = get_store().get(key)
+    if value is None:
+        raise GeneralFailure('Checkpoint not found, it may have expired. Key: {0}'.format(key))
+    return value
@@ -11,4 +11,16 @@ class AuthorizationError(GeneralFailure):
 
 
 class ThrottledError(GeneralFailure):
-    pass
\ No newline at end of file
+    pass
+
+
+class OutOfTimeError(GeneralFailure):
+    pass
+
+
+class UnavailableError(GeneralFailure):
+    pass
+
+
+class CircuitOpenError(GeneralFailure):
+    pass
@@ -0,0 +1,115 @@
+import re
+import fnmatch
+from collections import OrderedDict
+
+from scumblr_spillguard import log, metrics
+
+# file statuses scanned when a task doesn't configure `file_statuses`
+DEFAULT_STATUSES = ('added', 'modified', 'renamed', 'copied', 'changed')
+
+stats = {'files': 0, 'skipped_files': 0, 'oversized_files': 0, 'oversized_bytes': 0}
+
+_filters = (None, None)
+
+
+def compile_globs(globs):
+    """Compile a list of globs into a single regex, or None if there are none."""
+    if not globs:
+        return None
+    return re.compile('|'.join('(?:{0})'.format(fnmatch.translate(g)) for g in globs))
+
+
+class FileFilter(object):
+    """The file rules of a scumblr task compiled into a single matcher.
+
+    Rules are read from the task options::
+
+        include_paths       globs a file must match to be scanned
+        exclude_paths       globs of files never scanned, e.g. `vendor/*` or `*.min.js`
+        exclude_extensions  extensions of files never scanned, e.g. `png` or `lock`
+        file_statuses       github file statuses that are scanned, `removed` files are skipped by default
+        max_file_size       size in bytes above which blobs are not scanned
+    """
+    def __init__(self, options):
+        exclude = list(options.get('exclude_paths', []))
+        exclude.extend('*.' + e.lstrip('.') for e in options.get('exclude_extensions', []))
+
+        self.include = compile_globs(options.get('include_paths'))
+        self.exclude = compile_globs(exclude)
+        self.statuses = set(options.get('file_statuses', DEFAULT_STATUSES))
+        self.max_size = options.get('max_file_size')
+
+    def wants(self, f):
+        """Determine from a changed file's metadata if it should be scanned."""
+        status = f.get('status')
+        if status:
+            if status not in self.statuses:
+                return False
+
+            # a pure rename points at a blob we have already seen
+            if status == 'renamed' and not f.get('changes'):
+                return False
+
+        path = f.get('filename', '')
+        if self.include is not None and not self.include.match(path):
+            return False
+
+        if self.exclude is not None and self.exclude.match(path):
+            return False
+
+        return True
+
+    def fits(self, size):
+        """Determine if a blob of the given size should be scanned."""
+        return not self.max_size or size is None or size <= self.max_size
+
+
+def get_filters(configs):
+    """Return the file filters of each task, keyed by task id, compiled once per configuration."""
+    global _filters
+
+    if _filters[0] is not configs:
+        _filters = (configs, OrderedDict((c['id'], FileFilter(c['options'])) for c in configs))
+
+    return _filters[1]
+
+
+def wanted_tasks(filters, f):
+    """Return the ids of the tasks that want a changed file scanned.
+
+    Entries that carry the `size` of their blob, like those of the tree api, are also
+    checked against `max_file_size`, so oversized blobs are never fetched.
+    """
+    stats['files'] += 1
+    metrics.incr('FilteredFiles')
+    tasks = set(task_id for task_id, file_filter in filters.items() if file_filter.wants(f))
+
+    if not tasks:
+        log.debug('Skipping file. File: {0} Status: {1}'.format(f.get('filename'), f.get('status')))
+        stats['skipped_files'] += 1
+        metrics.incr('SkippedFiles')
+        return tasks
+
+    if f.get('size') is not None:
+        return fitting_tasks(filters, tasks, f['size'])
+
+    return tasks
+
+
+def fits_any(filters, tasks, size):
+    """Determine if any of the tasks wants a blob of the given size scanned."""
+    return any(filters[t].fits(size) for t in tasks)
+
+
+def fitting_tasks(filters, tasks, size):
+    """Return the tasks that still want a blob once its size is known."""
+    fitting = set(t for t in tasks if filters[t].fits(size))
+
+    if not fitting:
+        log.debug('Skipping oversized blob. Size: {0}'.format(size))
+        stats['oversized_files'] += 1
+        stats['oversized_bytes'] += size
+        metrics.incr('OversizedFiles')
+        metrics.incr('OversizedBytes', size)
+
+    return fitting
@@ -1,16 +1,179 @@
+import os
 import hmac
 import json
+import logging
+import time
 import hashlib
-import requests
-from retrying import retry
+import threading
 
-from scumblr_spillguard import log
-from scumblr_spillguard.utils import validate_ip
+from scumblr_spillguard import log, metrics
+from scumblr_spillguard.cache import MemoryStore
+from scumblr_spillguard.utils import validate_ip, CIDRIndex, retry
 from scumblr_spillguard.secrets import get_secret
-from scumblr_spillguard.exceptions import GeneralFailure, ThrottledError, AuthorizationError
+from scumblr_spillguard.sessions import get_session
+from scumblr_spillguard.exceptions import GeneralFailure, ThrottledError, AuthorizationError, OutOfTimeError
 
 
-GITHUB_CIDR_WHITELIST = ['192.30.252.0/22', '185.199.108.0/22', '140.82.112.0/20']
+# snapshot of the `hooks` ranges from github's meta api, used when the api can't be reached
+GITHUB_CIDR_WHITELIST = [
+    '192.30.252.0/22', '185.199.108.0/22', '140.82.112.0/20', '143.55.64.0/20',
+    '2a0a:a440::/29', '2606:50c0::/32'
+]
+
+# set to an empty string to only use the snapshot above
+GITHUB_META_URL = os.environ.get('GITHUB_META_URL', 'https://api.github.com/meta')
+# seconds hook ranges fetched from the meta api are trusted for
+HOOK_RANGES_TTL = int(os.environ.get('GITHUB_HOOK_RANGES_TTL', 3600))
+# seconds before retrying the meta api after a failure
+HOOK_RANGES_RETRY = 60
+# connect and read timeouts of the meta api, which is called without retries
+GITHUB_META_TIMEOUT = (1, 3)
+
+_hook_index = None
+_hook_index_expires = 0
+_hook_refresh = None
+_hook_lock = threading.Lock()
+
+# seconds every worker pauses when github throttles us without saying for how long
+THROTTLE_BACKOFF = float(os.environ.get('GITHUB_THROTTLE_BACKOFF', 5))
+# requests per second (and burst size) we allow ourselves while quota is plentiful
+GITHUB_RATE = float(os.environ.get('GITHUB_RATE', 20))
+GITHUB_BURST = int(os.environ.get('GITHUB_BURST', 20))
+# once remaining quota drops below this, pace requests to spread it until the reset
+GITHUB_RATE_RESERVE = int(os.environ.get('GITHUB_RATE_RESERVE', 500))
+# number of responses kept for conditional requests, blobs are never kept as they
+# are content addressed and can be large
+GITHUB_ETAG_CACHE_SIZE = int(os.environ.get('GITHUB_ETAG_CACHE_SIZE', 256))
+# media type that makes the blob api return a blob's content as is, rather than base64 in json
+GITHUB_RAW_MEDIA_TYPE = 'application/vnd.github.raw'
+
+
+class RateLimiter(object):
+    """Schedules the github requests made by all threads of a container.
+
+    Requests are paced with a token bucket. The quota and reset time github reports are
+    tracked across calls: when quota runs low the rate is lowered to spread what is left
+    until the reset, and once it is gone requests wait for `X-RateLimit-Reset`.
+
+    A wait that would run past the deadline of the current invocation raises
+    `OutOfTimeError` instead, so the work can be handed off or redelivered.
+    """
+    def __init__(self, rate=GITHUB_RATE, burst=GITHUB_BURST, reserve=GITHUB_RATE_RESERVE):
+        self.lock = threading.Lock()
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.reserve = reserve
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.remaining = None
+        self.reset = 0
+        self.paused_until = 0
+        self.deadline = None
+
+    def set_deadline(self, seconds):
+        """Limit waits to the given number of seconds from now, or lift the limit with None."""
+        with self.lock:
+            self.deadline = None if seconds is None else time.time() + seconds
+
+    def acquire(self):
+        """Block until a request may be made."""
+        while True:
+            with self.lock:
+                now = time.time()
+
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                elif self.remaining is not None and self.remaining <= 0 and now < self.reset:
+                    delay = self.reset - now
+                else:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        if self.remaining is not None:
+                            self.remaining -= 1
+                        return
+
+                    delay = (1 - self.tokens) / self.rate
+
+            if self.deadline is not None and now + delay > self.deadline:
+                raise OutOfTimeError('Github rate limit wait of {0:.0f}s exceeds the remaining time'.format(delay))
+
+            log.debug('Waiting {0:.2f}s before next Github request'.format(delay))
+            time.sleep(delay)
+
+    def update(self, headers):
+        """Record the quota github reported with a response."""
+        remaining = headers.get('X-RateLimit-Remaining')
+        if remaining is None:
+            return
+
+        with self.lock:
+            self.remaining = int(remaining)
+            self.reset = int(headers.get('X-RateLimit-Reset', self.reset))
+
+            if self.remaining < self.reserve:
+                window = max(self.reset - time.time(), 1)
+                self.rate = min(self.max_rate, max(self.remaining / window, 0.01))
+            else:
+                self.rate = self.max_rate
+
+    def pause(self, seconds):
+        """Stop all requests for the given number of seconds."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+
+limiter = RateLimiter()
+_etags = MemoryStore(GITHUB_ETAG_CACHE_SIZE)
+
+
+def fetch_hook_index():
+    """Fetch github's webhook source ranges from the meta api."""
+    session = get_session(GITHUB_META_URL, key='github-meta', retries=0, timeout=GITHUB_META_TIMEOUT)
+    response = session.get(GITHUB_META_URL)
+    response.raise_for_status()
+    return CIDRIndex(response.json()['hooks'])
+
+
+def refresh_hook_index():
+    """Replace the hook ranges with a fresh copy from the meta api, keeping them if it fails."""
+    global _hook_index, _hook_index_expires
+
+    try:
+        _hook_index = fetch_hook_index()
+        _hook_index_expires = time.time() + HOOK_RANGES_TTL
+    except Exception as e:
+        log.warning('Unable to fetch Github hook ranges, using snapshot. Error: {0}'.format(e))
+        _hook_index_expires = time.time() + HOOK_RANGES_RETRY
+
+
+def get_hook_index():
+    """Return the index of github's webhook source ranges.
+
+    These are the ranges last fetched by `refresh_hook_ranges`, or the snapshot in a
+    new container. Nothing is fetched here, so rejecting a request never waits on or
+    loads an http client.
+    """
+    global _hook_index
+
+    if _hook_index is None:
+        _hook_index = CIDRIndex(GITHUB_CIDR_WHITELIST)
+
+    return _hook_index
+
+
+def refresh_hook_ranges():
+    """Refresh expired hook ranges from the meta api in a background thread, so no request waits on it."""
+    global _hook_refresh
+
+    if GITHUB_META_URL and time.time() >= _hook_index_expires:
+        with _hook_lock:
+            if _hook_refresh is None or not _hook_refresh.is_alive():
+                _hook_refresh = threading.Thread(target=refresh_hook_index, daemon=True)
+                _hook_refresh.start()
 
 
 def github_thottled(exception):
@@ -19,27 +182,42 @@ def github_thottled(exception):
     return isinstance(exception, ThrottledError)
 
 
-def validate(event):
-    """Ensure the incoming event is a github event."""
-    authorize(event['body'], event['headers'], event['requestContext']['identity']['sourceIp'])
+def screen(event):
+    """Turn away events that are not github webhooks, returning the signature of those that may be.
+
+    The source ip and signature format are checked before the event itself, as they always
+    have been. Only the event is looked at, no secret is loaded and no session is opened.
+    """
+    identity = (event.get('requestContext') or {}).get('identity') or {}
+    signature = check_source(event.get('headers') or {}, identity.get('sourceIp'))
+
     if event.get('resource') == '/github':
-        if event.get('requestContext'):
-            if event['requestContext'].get('identity'):
-                if event['requestContext']['identity'].get('userAgent'):
-                    if event['requestContext']['identity']['userAgent'].startswith('GitHub-Hookshot'):
-                        return
+        if (identity.get('userAgent') or '').startswith('GitHub-Hookshot'):
+            return signature
 
     raise GeneralFailure('Invalid event. Event: {}'.format(event))
 
 
-def authorize(body, headers, source_ip):
-    """Ensures that we have a valid github webhook."""
-    validate_ip(source_ip, GITHUB_CIDR_WHITELIST)
+def validate(event):
+    """Ensure the incoming event is a github event, computing its HMAC once it passed `screen`."""
+    signature = screen(event)
+    refresh_hook_ranges()
+    check_signature(event['body'], signature)
+
 
-    sha_name, signature = headers['X-Hub-Signature'].split('=')
+def check_source(headers, source_ip):
+    """Ensure a webhook comes from github and is signed the way we expect, returning its signature."""
+    validate_ip(source_ip, get_hook_index())
+
+    sha_name, _, signature = (headers.get('X-Hub-Signature') or '').partition('=')
     if sha_name != 'sha1':
         raise AuthorizationError('Signature algorithm is not SHA1')
 
+    return signature
+
+
+def check_signature(body, signature):
+    """Ensure the HMAC of a webhook body matches its signature."""
     message_hmac = hmac.new(
         get_secret('ENCRYPTED_WEBHOOK_SECRET'),
         body.encode('utf-8'),
@@ -52,26 +230,97 @@ def authorize(body, headers, source_ip):
     log.debug('Computed HMAC {} matches signature {}'.format(message_hmac.hexdigest(), signature))
 
 
-@retry(retry_on_exception=github_thottled, wait_random_min=1000, wait_random_max=10000)
-def request(url):
-    """Attempt to make a Github request."""
+def authorize(body, headers, source_ip):
+    """Ensures that we have a valid github webhook."""
+    signature = check_source(headers, source_ip)
+    refresh_hook_ranges()
+    check_signature(body, signature)
+
+
+def is_blob_url(url):
+    return '/git/blobs/' in url
+
+
+def send(url, headers, stream=False):
+    """Make a Github request scheduled by the container wide `limiter`.
+
+    Raises `ThrottledError` if github throttled us, after pausing the limiter for as long
+    as github asked.
+    """
     params = {'access_token': get_secret('ENCRYPTED_GITHUB_TOKEN')}
 
     log.debug('Github Request. Url: {}'.format(url))
 
-    response = requests.get(url, params=params)
+    limiter.acquire()
+    response = get_session(url).get(url, params=params, headers=headers, stream=stream)
+    limiter.update(response.headers)
+
+    if response.status_code == 429 or (
+            response.status_code == 403 and (
+                response.headers.get('X-RateLimit-Remaining') == '0' or 'Retry-After' in response.headers)):
+        log.info('Throttled by Github. Status: {0} X-RateLimit-Limit: {1}'.format(
+            response.status_code, response.headers.get('X-RateLimit-Limit')))
+        response.close()
+
+        if 'Retry-After' in response.headers:
+            limiter.pause(float(response.headers['Retry-After']))
+        elif response.headers.get('X-RateLimit-Remaining') != '0':
+            limiter.pause(THROTTLE_BACKOFF)
+
+        raise ThrottledError()
+
+    return response
+
+
+@retry(retry_on_exception=github_thottled, stop_max_attempt_number=5)
+def request(url):
+    """Attempt to make a Github request.
+
+    Requests are scheduled by the container wide `limiter`, which also takes care of waiting
+    out throttling before a retry. Responses are revalidated with their ETag so repeated
+    fetches come back as a 304 that doesn't count against our quota.
+    """
+    headers = {}
+
+    cached = None if is_blob_url(url) else _etags.get(url)
+    if cached:
+        headers['If-None-Match'] = cached[0]
+
+    response = send(url, headers)
+
+    if response.status_code == 304 and cached:
+        log.debug('Github Response. Status: 304 Url: {0}'.format(url))
+        return cached[1]
 
     if not response.ok:
         raise GeneralFailure('Request to Github failed. URL: {0}'.format(url))
 
-    if response.headers['X-RateLimit-Remaining'] == 0:
-        log.info('Throttled by Github. X-RateLimit-Limit: {0}'.format(
-            response.headers['X-RateLimit-Limit']))
-        raise ThrottledError()
+    data = response.json()
+    metrics.incr('GithubBytes', len(response.content))
+
+    if response.headers.get('ETag') and not is_blob_url(url):
+        _etags.set(url, (response.headers['ETag'], data))
+
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('Github Response. Status: {0} Data: {1}'.format(
+            response.status_code,
+            json.dumps(data, indent=2)
+        ))
+
+    return data
+
 
-    log.debug('Github Response. Status: {0} Data: {1}'.format(
-        response.status_code,
-        json.dumps(response.json(), indent=2)
-    ))
+@retry(retry_on_exception=github_thottled, stop_max_attempt_number=5)
+def request_blob(url):
+    """Open a blob's raw content as a streamed response.
+
+    Only the headers have been read when it is returned, the content is read with
+    `iter_content` and the response must be closed if it isn't read to the end.
+    """
+    response = send(url, {'Accept': GITHUB_RAW_MEDIA_TYPE}, stream=True)
+
+    if not response.ok:
+        response.close()
+        raise GeneralFailure('Request to Github failed. URL: {0}'.format(url))
 
-    return response.json()
+    return response
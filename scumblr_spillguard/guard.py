@@ -0,0 +1,227 @@
+import os
+import sys
+import time
+import threading
+
+from scumblr_spillguard import log, metrics
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:  # python < 3.11
+    import sre_parse
+    import sre_constants
+
+# seconds a single term pattern may spend searching one file before it is quarantined
+PATTERN_BUDGET = float(os.environ.get('SPILLGUARD_PATTERN_BUDGET', 1))
+# which regex patterns run in a worker process that is killed once they exceed the budget:
+# 'all' of them, only 'risky' ones with nested unbounded repeats or 'off'. The risky check
+# is a heuristic, patterns like `(a|a)*b` backtrack just as badly without being flagged
+GUARD_MODE = os.environ.get('SPILLGUARD_PATTERN_GUARD', 'all')
+
+REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# patterns that blew their budget, and why, for the lifetime of the container
+quarantined = {}
+
+_risky = {}
+
+
+class PatternTimeout(Exception):
+    pass
+
+
+def nested_repeat(items, repeated=False):
+    """Determine if a parsed pattern has an unbounded repeat inside another one."""
+    for op, av in items:
+        if op in REPEATS:
+            unbounded = av[1] == sre_constants.MAXREPEAT
+            if unbounded and repeated:
+                return True
+            if nested_repeat(av[2], repeated or unbounded):
+                return True
+        elif op == sre_constants.SUBPATTERN:
+            if nested_repeat(av[-1], repeated):
+                return True
+        elif op == sre_constants.BRANCH:
+            if any(nested_repeat(branch, repeated) for branch in av[1]):
+                return True
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            if nested_repeat(av[1], repeated):
+                return True
+
+    return False
+
+
+def is_risky(pattern):
+    """Determine if a pattern is prone to catastrophic backtracking, e.g. `(a+)+`."""
+    risky = _risky.get(pattern)
+
+    if risky is None:
+        try:
+            risky = nested_repeat(sre_parse.parse(pattern))
+        except Exception:
+            risky = False
+        _risky[pattern] = risky
+
+    return risky
+
+
+def work(stdin, stdout):
+    """Worker process loop, answers pickled (pattern, flags, contents) with (found, seconds)."""
+    import re
+    import pickle
+    compiled = {}
+
+    # tell the parent we are up, so interpreter start up isn't counted against a budget
+    pickle.dump(None, stdout)
+    stdout.flush()
+
+    while True:
+        try:
+            pattern, flags, contents = pickle.load(stdin)
+        except EOFError:
+            return
+
+        regex = compiled.get((pattern, flags))
+        if regex is None:
+            regex = compiled[(pattern, flags)] = re.compile(pattern, flags)
+
+        start = time.perf_counter()
+        found = regex.search(contents) is not None
+        pickle.dump((found, time.perf_counter() - start), stdout)
+        stdout.flush()
+
+
+class Worker(object):
+    """A child process running regex searches, killed if one runs past its budget.
+
+    The child is a fresh interpreter rather than a fork, forking a process that runs
+    scans on several threads could copy locks held by the other threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.process = None
+
+    def start(self):
+        import pickle
+        import subprocess
+
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in (ROOT, os.environ.get('PYTHONPATH')) if p))
+        # lambda has no /dev/shm, so pipes are the only ipc we can use
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'scumblr_spillguard.guard'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env
+        )
+        pickle.load(self.process.stdout)
+
+    def stop(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process.stdin.close()
+            self.process.stdout.close()
+        self.process = None
+
+    def search(self, compiled, contents, budget):
+        """Search contents in the worker, returning (found, seconds) or raising `PatternTimeout`."""
+        import pickle
+        import select
+
+        if isinstance(contents, memoryview):
+            contents = contents.tobytes()
+
+        with self.lock:
+            if self.process is None or self.process.poll() is not None:
+                self.start()
+
+            pickle.dump((compiled.pattern, compiled.flags, contents), self.process.stdin, pickle.HIGHEST_PROTOCOL)
+            self.process.stdin.flush()
+
+            if not select.select([self.process.stdout], [], [], budget)[0]:
+                self.stop()
+                raise PatternTimeout('Pattern exceeded its {0}s budget. Pattern: {1}'.format(budget, compiled.pattern))
+
+            try:
+                return pickle.load(self.process.stdout)
+            except EOFError:
+                self.stop()
+                raise PatternTimeout('Worker exited while searching. Pattern: {0}'.format(compiled.pattern))
+
+
+class WorkerPool(object):
+    """Workers handed out to one searching thread at a time, so threads never wait on each other."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def search(self, compiled, contents, budget):
+        with self.lock:
+            worker = self.idle.pop() if self.idle else Worker()
+
+        try:
+            return worker.search(compiled, contents, budget)
+        finally:
+            with self.lock:
+                self.idle.append(worker)
+
+    def stop(self):
+        with self.lock:
+            for worker in self.idle:
+                worker.stop()
+
+
+pool = WorkerPool()
+
+
+def quarantine(pattern, reason):
+    """Stop running a pattern for the lifetime of the container."""
+    if pattern not in quarantined:
+        log.error('Quarantining term pattern. Pattern: {0} Reason: {1}'.format(pattern, reason))
+        quarantined[pattern] = reason
+        metrics.incr('QuarantinedPatterns')
+
+
+def guarded(pattern):
+    if GUARD_MODE == 'risky':
+        return is_risky(pattern)
+    return GUARD_MODE != 'off'
+
+
+def search(pattern, compiled, contents, budget=None):
+    """Search contents for a term pattern within its time budget.
+
+    Guarded patterns run in a worker process and are killed once over budget, others run
+    inline and are quarantined after the fact if they took too long. Returns None for a
+    quarantined pattern.
+    """
+    if pattern in quarantined:
+        return None
+
+    budget = PATTERN_BUDGET if budget is None else budget
+
+    if guarded(pattern):
+        try:
+            return pool.search(compiled, contents, budget)[0]
+        except PatternTimeout:
+            quarantine(pattern, 'killed after exceeding its {0}s budget'.format(budget))
+            return None
+
+    start = time.perf_counter()
+    found = compiled.search(contents) is not None
+    elapsed = time.perf_counter() - start
+
+    if elapsed > budget:
+        quarantine(pattern, 'took {0:.2f}s, over its {1}s budget'.format(elapsed, budget))
+
+    return found
+
+
+def quarantined_terms(terms):
+    """Return the names of the terms whose pattern is quarantined."""
+    return sorted(name for name, pattern in terms.items() if pattern in quarantined)
+
+
+if __name__ == '__main__':
+    work(sys.stdin.buffer, sys.stdout.buffer)
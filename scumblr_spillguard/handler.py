@@ -1,29 +1,148 @@
-import re
+import os
 import json
+import zlib
 import base64
-from raven_python_lambda import RavenLambdaWrapper
+import logging
+import functools
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 
-from scumblr_spillguard import log
-from scumblr_spillguard import scumblr, github, bitbucket
+from scumblr_spillguard import log, metrics, guard
+from scumblr_spillguard import scumblr, github, bitbucket, secrets, blobs, filters, deliveries
+from scumblr_spillguard.queues import get_queue
+from scumblr_spillguard.utils import invoke_async, raven_handler
+from scumblr_spillguard.cache import blob_cache
+from scumblr_spillguard.scanner import get_scanner, get_task_scanner
+from scumblr_spillguard.exceptions import GeneralFailure, OutOfTimeError
+
+# decrypt all of our secrets in parallel while the container is starting
+if os.environ.get('PREFETCH_SECRETS'):
+    try:
+        secrets.prefetch()
+    except Exception as e:
+        log.exception(e)
+
+# maximum number of github requests in flight for a single push
+GITHUB_CONCURRENCY = int(os.environ.get('GITHUB_CONCURRENCY', 8))
+# fetch the net changes of a push with the compare api instead of commit by commit
+GITHUB_COMPARE = os.environ.get('GITHUB_COMPARE', '').lower() in ('1', 'true', 'yes')
+# github only lists the changed files of a comparison up to this many, and only on its first page
+COMPARE_FILES_LIMIT = 300
+# maximum number of bitbucket requests in flight for a batch of commits
+BITBUCKET_CONCURRENCY = int(os.environ.get('BITBUCKET_CONCURRENCY', 8))
+# milliseconds kept in reserve to send results and hand off the rest of a push
+TIME_RESERVE_MS = int(os.environ.get('SPILLGUARD_TIME_RESERVE_MS', 30000))
+# number of queued pushes the worker takes from the queue at a time
+QUEUE_BATCH_SIZE = int(os.environ.get('SPILLGUARD_QUEUE_BATCH_SIZE', 10))
+# name or arn of the `github_worker_handler` function pushes are continued with when no queue is configured
+WORKER_FUNCTION = os.environ.get('SPILLGUARD_WORKER_FUNCTION')
+# bytes a message may take up, SQS and asynchronous invocations accept 256KB with some left for the envelope
+MAX_MESSAGE_BYTES = 250 * 1024
 
 
 def find_violations(contents, terms):
     """Find any violations in a given file."""
-    hits = []
+    return get_scanner(terms).scan(contents)
 
-    for name, pattern in terms.items():
-        match = re.search(pattern, contents, flags=re.MULTILINE | re.DOTALL)
 
-        if match:
-            log.debug("Contents hit on pattern {}".format(pattern))
-            hits.append(name)
+def group_hits(keys, tasks=None):
+    """Group (task id, term name) hits by task, keeping only the given task ids if any."""
+    hits = {}
+
+    for task_id, name in keys:
+        if tasks is None or task_id in tasks:
+            hits.setdefault(task_id, []).append(name)
 
     return hits
 
 
-def process_task_configs(commit, configs):
+def find_task_violations(contents, configs, tasks=None):
+    """Find violations for all task configs with a single scan of the contents.
+
+    If tasks is given only hits belonging to those task ids are kept.
+    """
+    return group_hits(get_task_scanner(configs).scan(contents), tasks)
+
+
+def scan_blob(commit, configs):
+    """Scan a commit's full blob for all task configs, using previously cached results when available."""
+    if commit.get('blob_hits') is not None:
+        return commit['blob_hits']
+
+    scanner = get_task_scanner(configs)
+    sha = commit.get('blob_sha')
+
+    keys = blob_cache.get(sha, scanner.hash) if sha else None
+    if keys is None:
+        if isinstance(commit['contents'], (blobs.Blob, blobs.RawBlob)):
+            try:
+                keys = blobs.scan(scanner, commit['contents'])
+            except Exception as e:
+                log.exception(e)
+                return []
+        else:
+            keys = scanner.scan(commit['contents'])
+
+        metrics.incr('FilesScanned')
+
+        # results missing a quarantined pattern must not stop the blob being scanned again
+        if sha and not scanner.quarantined():
+            blob_cache.set(sha, scanner.hash, keys)
+
+    return keys
+
+
+def scans_diff(config):
+    """Determine if a task only wants the lines added by a commit scanned."""
+    return config['options'].get('scan_mode') == 'diff'
+
+
+def added_lines(f):
+    """Return the lines added by a changed file's patch, or None if the patch is missing or truncated."""
+    patch = f.get('patch')
+    if patch is None:
+        return None
+
+    added = [l[1:] for l in patch.split('\n') if l.startswith('+')]
+
+    # github cuts large patches short, don't trust one with fewer additions than it claims
+    if len(added) < f.get('additions', 0):
+        return None
+
+    return '\n'.join(added)
+
+
+def find_commit_violations(commit, configs):
+    """Find violations for all task configs, scanning added lines for tasks in diff mode."""
+    diff_tasks = set(c['id'] for c in configs if scans_diff(c))
+    patch_contents = commit.get('patch_contents')
+
+    tasks = commit.get('tasks')
+
+    if not diff_tasks or patch_contents is None:
+        return group_hits(scan_blob(commit, configs), tasks=tasks)
+
+    hits = find_task_violations(patch_contents, configs, tasks=diff_tasks)
+
+    if len(diff_tasks) < len(configs):
+        full_tasks = set(c['id'] for c in configs) - diff_tasks
+        hits.update(group_hits(scan_blob(commit, configs), tasks=full_tasks))
+
+    if tasks is not None:
+        hits = dict((task_id, names) for task_id, names in hits.items() if task_id in tasks)
+
+    return hits
+
+
+def process_task_configs(commit, configs, results=None):
     """Iterates over all items in config analyzing each.
 
+    Findings are collected into results, keyed by task id, so that a whole push can be
+    sent to scumblr with `send_task_results`. Without results they are sent right away.
+    The `commit` of a result describes the first commit with findings, each entry of
+    `findings` carries the ref, committer and url of its own commit.
+
     Scumblr expects the following format::
 
     {
@@ -58,6 +177,13 @@ def process_task_configs(commit, configs):
       "findings": [
         {
           "commit_id": "74ff78c232c8d8516f42c69767d30b5ef37e4041",
+          "ref": "refs/heads/master",
+          "committer": {
+            "name": "GitHub",
+            "email": "noreply@github.com",
+            "username": "web-flow"
+          },
+          "html_url": "https://github.com/Netflix-Skunkworks/test-gh-spillguard",
           "findings": [
             {
               "content_urls": "https://api.github.com/repos/Netflix-Skunkworks/test-gh-spillguard/contents/test1?ref=74ff78c232c8d8516f42c69767d30b5ef37e4041",
@@ -71,54 +197,486 @@ def process_task_configs(commit, configs):
     }
 
     """
+    violations = find_commit_violations(commit, configs)
+
+    send = results is None
+    if send:
+        results = {}
+
     for config in configs:
-        result = {
-            'task_id': config['id'],
-            'task_type': config['task_type'],
-            'findings': [],
-            'config': {
-                'id': config['id'],
+        hits = violations.get(config['id'])
+
+        if not hits:
+            continue
+
+        result = results.get(config['id'])
+        if result is None:
+            result = results[config['id']] = {
+                'task_id': config['id'],
                 'task_type': config['task_type'],
-                'options': config['options']
-            },
-            'commit': {
-                'ref': commit['ref'],
-                'head_commit': {
-                    'committer': commit['committer']
+                'findings': [],
+                'config': {
+                    'id': config['id'],
+                    'task_type': config['task_type'],
+                    'options': config['options']
                 },
-                'repository': {'html_url': commit['html_url']}
+                'commit': {
+                    'ref': commit['ref'],
+                    'head_commit': {
+                        'committer': commit['committer']
+                    },
+                    'repository': {'html_url': commit['html_url']}
+                }
             }
+
+        finding = {
+            'hits': hits,
+            'content_urls': commit['contents_url'].split('?')[0]
         }
 
-        log.info('Working on config. Config: {0}'.format(
-            json.dumps(config, indent=2)
-        ))
+        for commit_findings in result['findings']:
+            if commit_findings['commit_id'] == commit['sha']:
+                commit_findings['findings'].append(finding)
+                break
+        else:
+            result['findings'].append({
+                'commit_id': commit['sha'],
+                'ref': commit['ref'],
+                'committer': commit['committer'],
+                'html_url': commit['html_url'],
+                'findings': [finding]
+            })
+
+        log.info('Found hits. Task: {0} Commit: {1} Hits: {2}'.format(config['id'], commit['sha'], hits))
+
+    if send:
+        send_task_results(results)
+
+    return results
+
+
+def finding_key(task_id, commit_findings, finding):
+    return deliveries.sent_key(task_id, commit_findings['commit_id'], finding['content_urls'], finding['hits'])
+
+
+def unsent_findings(result):
+    """Return the findings of a result, by commit, that have not been sent to scumblr yet."""
+    unsent = []
+
+    for c in result['findings']:
+        findings = [f for f in c['findings'] if not deliveries.seen(finding_key(result['task_id'], c, f))]
+        if findings:
+            unsent.append(dict(c, findings=findings))
+
+    return unsent
+
+
+def send_task_results(results):
+    """Send the collected results to scumblr, one request per task.
+
+    Findings already sent, e.g. by an earlier attempt that failed partway, are left out.
+    If sending one task fails the others are still sent, and the first error is raised
+    once they have been.
+
+    Terms of the task that were quarantined for exceeding their time budget are listed
+    in `quarantined_terms`, as the findings may be missing their hits.
+    """
+    error = None
+
+    for result in results.values():
+        findings = unsent_findings(result)
+        if result['findings'] and not findings:
+            continue
+
+        result = dict(result, findings=findings)
+
+        quarantined = guard.quarantined_terms(result['config']['options'].get('github_terms', {}))
+        if quarantined:
+            result['quarantined_terms'] = quarantined
+
+        log.error('Has findings. Sending result to scumblr. Task: {0} Commits: {1}'.format(
+            result['task_id'], len(result['findings'])))
+        try:
+            with metrics.timer('Submit'):
+                scumblr.send_results(result)
+        except Exception as e:
+            log.exception(e)
+            error = error or e
+            continue
+
+        for c in findings:
+            for f in c['findings']:
+                deliveries.mark(finding_key(result['task_id'], c, f))
+
+    if error is not None:
+        raise error
+
+
+def report_quarantined(configs):
+    """Alert on the quarantined terms of every task, whether or not it found anything.
+
+    A quarantined term is not searched for, so a task may be missing findings without
+    having any to carry `quarantined_terms` to scumblr.
+    """
+    if not guard.quarantined:
+        return
+
+    for config in configs:
+        quarantined = guard.quarantined_terms(config['options'].get('github_terms', {}))
+        if quarantined:
+            log.error('Task has quarantined terms, they were not searched for. Task: {0} Terms: {1}'.format(
+                config['id'], quarantined))
+            metrics.incr('QuarantinedTerms', len(quarantined))
+
+
+def fetch_commit(url):
+    """Fetch a commit and its changed files."""
+    with metrics.timer('CommitFetch'):
+        return github.request(url)
+
+
+def fetch_blob(blobs_url, f, fits=None):
+    """Open the raw content of a changed file's blob, it is streamed when it is scanned.
+
+    The first chunk is read right away, unless fits rejects the size the response
+    announced, in which case the blob is closed without reading any of its content.
+    """
+    url = blobs_url + '/' + f['sha']
+
+    with metrics.timer('BlobFetch'):
+        blob = blobs.RawBlob(lambda: github.request_blob(url), size=f.get('size'))
+
+        if fits is not None and blob.size is not None and not fits(blob.size):
+            blob.close()
+        else:
+            blob.peek()
+
+    return blob
+
+
+def normalize_commit(body, c, commit_data, f, contents, patch_contents, blob_hits=None, tasks=None):
+    """Combine push, commit and file information into the commit data we analyze."""
+    return dict(
+        commit_data,
+        tasks=tasks,
+        contents=contents,
+        patch_contents=patch_contents,
+        blob_sha=f['sha'],
+        blob_hits=blob_hits,
+        contents_url=f['contents_url'],
+        committer=c['committer'],
+        ref=body['ref'],
+        html_url=body['repository']['html_url']
+    )
+
+
+@contextmanager
+def cancelling():
+    """Track pending futures, cancelling the ones not yet started if we stop early."""
+    pending = {}
+    try:
+        yield pending
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def fetch_commit_files(body, concurrency=GITHUB_CONCURRENCY, fetch_blobs=True, terms_hash=None,
+                       file_filters=None, skip=()):
+    """Fetch every commit of a push and the blob of each changed file concurrently.
+
+    Yields normalized commit data for each file as soon as its blob has been opened. When
+    fetch_blobs is False, blobs are only fetched for files whose patch is missing or truncated.
+    Blobs already scanned with the term set identified by terms_hash are not fetched again,
+    their cached hits are passed along instead. Files no task wants according to
+    file_filters, and files whose contents url is in skip, are skipped before anything is fetched.
+    """
+    commit_url = body['repository']['commits_url'][:-len('{/sha}')]
+    blobs_url = body['repository']['blobs_url'][:-len('{/sha}')]
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, cancelling() as pending:
+        for c in body['commits']:
+            pending[executor.submit(fetch_commit, commit_url + '/' + c['id'])] = (c, None, None, None)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                c, commit_data, f, tasks = pending.pop(future)
+
+                if commit_data is None:
+                    commit_data = future.result()
+                    for f in commit_data['files']:
+                        if f['contents_url'] in skip:
+                            continue
+
+                        tasks = filters.wanted_tasks(file_filters, f) if file_filters is not None else None
+                        if tasks is not None and not tasks:
+                            continue
+
+                        patch_contents = added_lines(f)
+
+                        if not fetch_blobs and patch_contents is not None:
+                            yield normalize_commit(body, c, commit_data, f, None, patch_contents, tasks=tasks)
+                            continue
+
+                        blob_hits = blob_cache.get(f['sha'], terms_hash) if terms_hash else None
+                        if blob_hits is not None:
+                            yield normalize_commit(
+                                body, c, commit_data, f, None, patch_contents, blob_hits, tasks=tasks)
+                            continue
+
+                        fits = functools.partial(filters.fits_any, file_filters, tasks) if tasks else None
+                        pending[executor.submit(fetch_blob, blobs_url, f, fits)] = (c, commit_data, f, tasks)
+                    continue
+
+                blob = future.result()
+                if tasks is not None:
+                    tasks = filters.fitting_tasks(file_filters, tasks, blob.size)
+                    if not tasks:
+                        blob.close()
+                        continue
+
+                yield normalize_commit(body, c, commit_data, f, blob, added_lines(f), tasks=tasks)
+
+
+def can_compare(body):
+    """Determine if a push has a base and head we can compare."""
+    empty = '0' * 40
+    return bool(
+        body['repository'].get('compare_url') and
+        body.get('before') and body['before'] != empty and
+        body.get('after') and body['after'] != empty
+    )
+
+
+def fetch_compare(body):
+    """Return the net files changed by a push from the compare api.
+
+    Returns None if github truncated the file list, the push has to be fetched commit by commit.
+    """
+    url = body['repository']['compare_url'].format(base=body['before'], head=body['after'])
+    files = fetch_commit(url).get('files', [])
+
+    if len(files) >= COMPARE_FILES_LIMIT:
+        return None
+
+    return list(OrderedDict((f['filename'], f) for f in files).values())
+
+
+def commit_for_file(body, filename):
+    """Find the last commit of a push that added or modified a file."""
+    for c in reversed(body['commits']):
+        if filename in c.get('added', []) or filename in c.get('modified', []):
+            return c
+
+    if body.get('head_commit'):
+        return body['head_commit']
+
+    if body['commits']:
+        return body['commits'][-1]
+
+    return {'id': body['after'], 'committer': {}}
+
+
+def fetch_push_files(body, concurrency=GITHUB_CONCURRENCY, fetch_blobs=True, terms_hash=None,
+                     file_filters=None, skip=()):
+    """Fetch the net changes of a whole push with the compare api.
+
+    Each distinct blob is fetched once, files are attributed to the last commit of the push
+    that touched them. Note that content added and removed again within the push is not seen.
+    Pushes changing more files than the compare api lists are fetched commit by commit instead.
+    Arguments behave as for `fetch_commit_files`.
+    """
+    changed = fetch_compare(body)
+
+    if changed is None:
+        log.info('Compare truncated at {0} files, fetching commits instead'.format(COMPARE_FILES_LIMIT))
+        yield from fetch_commit_files(body, concurrency, fetch_blobs, terms_hash, file_filters, skip)
+        return
+
+    blobs_url = body['repository']['blobs_url'][:-len('{/sha}')]
+
+    def normalize(f, contents, blob_hits=None):
+        c = commit_for_file(body, f['filename'])
+        return normalize_commit(
+            body, c, {'sha': c['id']}, f, contents, added_lines(f), blob_hits, tasks=wanted.get(f['filename']))
+
+    wanted = {}
+    by_sha = OrderedDict()
+    for f in changed:
+        if f['contents_url'] in skip:
+            continue
+
+        if file_filters is not None:
+            wanted[f['filename']] = filters.wanted_tasks(file_filters, f)
+            if not wanted[f['filename']]:
+                continue
+
+        by_sha.setdefault(f['sha'], []).append(f)
 
-        hits = find_violations(commit['contents'],
-                               config['options']['github_terms'])  # todo 'github_terms' should be generic 'terms'
+    log.debug('Push changes {0} files with {1} distinct blobs'.format(
+        sum(len(files) for files in by_sha.values()), len(by_sha)))
 
-        if hits:
-            result['findings'].append(
-                {
-                    'commit_id': commit['sha'],
-                    'findings': [
-                        {
-                            'hits': hits,
-                            'content_urls': commit['contents_url'].split('?')[0]
-                        }
-                    ]}
-            )
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, cancelling() as pending:
+        for sha, files in by_sha.items():
+            if not fetch_blobs and all(added_lines(f) is not None for f in files):
+                for f in files:
+                    yield normalize(f, None)
+                continue
+
+            blob_hits = blob_cache.get(sha, terms_hash) if terms_hash else None
+            if blob_hits is not None:
+                for f in files:
+                    yield normalize(f, None, blob_hits)
+                continue
+
+            fits = None
+            if file_filters is not None:
+                fits = functools.partial(
+                    filters.fits_any, file_filters, set().union(*(wanted[f['filename']] for f in files)))
+            pending[executor.submit(fetch_blob, blobs_url, files[0], fits)] = files
+
+        for future in as_completed(pending):
+            blob = future.result()
+
+            for f in pending[future]:
+                if file_filters is not None:
+                    wanted[f['filename']] = filters.fitting_tasks(file_filters, wanted[f['filename']], blob.size)
+                    if not wanted[f['filename']]:
+                        continue
+
+                yield normalize(f, blob)
+
+            blob.close()
+
+
+def out_of_time(context):
+    """Determine if the invocation should stop and hand off its remaining work."""
+    return context is not None and context.get_remaining_time_in_millis() < TIME_RESERVE_MS
+
+
+def pack_message(body, delivery, done=()):
+    """Build the queue or invocation message for a push from its json body.
+
+    The body and the contents urls already processed are compressed. If that is still too
+    large to send, it is checkpointed to the dedupe store and only its key is sent.
+    """
+    payload = json.dumps({'body': body, 'done': sorted(done)}).encode('utf-8')
+    payload = base64.b64encode(zlib.compress(payload)).decode('ascii')
+
+    if len(payload) <= MAX_MESSAGE_BYTES:
+        return {'payload': payload, 'delivery': delivery}
+
+    return {'checkpoint': deliveries.save_checkpoint(payload), 'delivery': delivery}
+
+
+def unpack_message(message):
+    """Return the body, delivery and processed files of a message built by `pack_message`."""
+    if message.get('checkpoint'):
+        payload = deliveries.load_checkpoint(message['checkpoint'])
+    elif message.get('payload'):
+        payload = message['payload']
+    else:
+        return message
+
+    unpacked = json.loads(zlib.decompress(base64.b64decode(payload)).decode('utf-8'))
+    unpacked['delivery'] = message.get('delivery')
+    return unpacked
+
+
+def continue_push(context, body, delivery, done):
+    """Hand a partially processed push to the queue, or to a new invocation of the worker."""
+    message = pack_message(json.dumps(body), delivery, done)
+    log.info('Out of time, continuing push later. Processed files: {0}'.format(len(done)))
+
+    queue = get_queue()
+    if queue is not None:
+        queue.send(message)
+    elif WORKER_FUNCTION:
+        invoke_async(WORKER_FUNCTION, {'continuation': message})
+    else:
+        raise GeneralFailure('Unable to continue push, neither a queue nor a worker function is configured.')
+
+
+def process_message(message, context=None):
+    """Process a push queued by `github_handler` or handed off by `continue_push`."""
+    message = unpack_message(message)
+    process_push(json.loads(message['body']), message.get('delivery'), context, message.get('done'))
+
+
+def process_push(body, delivery=None, context=None, done=None):
+    """Scan every file changed by a github push and send any findings to scumblr.
+
+    Deliveries and commits that were already scanned with the current terms are skipped,
+    as are the files in done, a list of contents urls processed by a previous invocation.
+    If the lambda context runs low on time, or github's rate limit would make a fetch wait
+    past it, the findings so far are sent and the rest of the push is continued later.
+    """
+    if deliveries.seen_delivery(delivery):
+        return
+
+    # never wait on github's rate limit for longer than this invocation has left
+    github.limiter.set_deadline(
+        context.get_remaining_time_in_millis() / 1000.0 - TIME_RESERVE_MS / 1000.0 if context else None)
+
+    # get search terms from scumblr
+    with metrics.timer('ConfigFetch'):
+        config = scumblr.get_config('GithubEventAnalyzer')
+    terms_hash = get_task_scanner(config).hash
+    repository = body['repository']['html_url']
+
+    commits = body['commits']
+    body = dict(body, commits=deliveries.new_commits(repository, commits, terms_hash))
 
-        if result['findings']:
-            log.error('Has findings. Sending result to scumblr. Result: {0}'.format(json.dumps(result, indent=2)))
-            scumblr.send_results(result)
+    log.debug('Body contains {} new commits'.format(len(body['commits'])))
 
-        log.warning('Finished working on config. Result: {0}'.format(
-            json.dumps(result, indent=2),
-        ))
+    if not body['commits']:
+        deliveries.mark_processed(repository, [], terms_hash, delivery)
+        return
 
+    done = set(done or [])
 
-@RavenLambdaWrapper()
+    kwargs = {
+        # blobs are only needed if some task scans whole files rather than just the added lines
+        'fetch_blobs': not all(scans_diff(c) for c in config),
+        'terms_hash': terms_hash,
+        'file_filters': filters.get_filters(config),
+        'skip': done
+    }
+
+    if GITHUB_COMPARE and can_compare(body):
+        files = fetch_push_files(body, **kwargs)
+    else:
+        files = fetch_commit_files(body, **kwargs)
+
+    results = {}
+    finished = False
+    try:
+        for commit_data in files:
+            process_task_configs(commit_data, config, results)
+            done.add(commit_data['contents_url'])
+
+            if out_of_time(context):
+                break
+        else:
+            finished = True
+    except OutOfTimeError as e:
+        # a fetch would have waited on github's rate limit past the end of this invocation
+        log.warning('Unable to finish push in time. Error: {0}'.format(e))
+    files.close()
+
+    report_quarantined(config)
+    send_task_results(results)
+
+    if not finished:
+        continue_push(context, body, delivery, done)
+        return
+
+    deliveries.mark_processed(repository, body['commits'], terms_hash, delivery)
+
+
+@metrics.flushing
 def github_handler(event, context):
     """
     Handles the processing of Github commit events.
@@ -127,51 +685,218 @@ def github_handler(event, context):
 
     1) Receive Github Webhook event.
     2) Validate event for SourceIp, User-Agent and HMAC digest using a pre-shared secret.
-    3) Fetch terms from Scumblr for processing.
-    4) Fetch commit information from Github.
-    5) Fetch full file information via the blob api.
-    6) Analyze blob with terms defined by the Scumblr configuration.
-    7) Return analysis results to Scumblr.
+    3) Enqueue the push for `github_worker_handler` if a queue is configured.
+    4) Fetch terms from Scumblr for processing.
+    5) Fetch commit information from Github.
+    6) Fetch full file information via the blob api.
+    7) Analyze blob with terms defined by the Scumblr configuration.
+    8) Return analysis results to Scumblr.
+
+    Events that are not github webhooks by their source ip, signature header or user agent
+    are answered with a 403 before anything heavy, sentry included, is loaded.
     """
-    log.debug('Entering lambda handler with event: {}'.format(json.dumps(event, indent=2)))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('Entering lambda handler with event: {}'.format(json.dumps(event, indent=2)))
 
     # github has a very low timeout (10s) we make sure that we can prewarm our function to prevent
     # the service from timing out
     if event.get('source') == 'aws.events':
         return {'statusCode': '200', 'body': '{}'}
 
-    github.validate(event)
-    body = json.loads(event['body'])
+    try:
+        with metrics.timer('Validate'):
+            github.screen(event)
+    except GeneralFailure as e:
+        log.warning('Rejecting event. Error: {0}'.format(e))
+        return {'statusCode': '403', 'body': '{}'}
 
-    commit_url = body['repository']['commits_url'][:-len('{/sha}')]
-    blobs_url = body['repository']['blobs_url'][:-len('{/sha}')]
+    return process_webhook(event, context)
 
-    # get search terms from scumblr
-    config = scumblr.get_config('GithubEventAnalyzer')
 
-    log.debug('Body contains {} commits'.format(len(body['commits'])))
+@raven_handler
+def process_webhook(event, context):
+    """Authenticate a github webhook that passed `github.screen`, then scan or enqueue its push."""
+    with metrics.timer('Validate'):
+        github.validate(event)
+
+    delivery = event['headers'].get('X-GitHub-Delivery')
+    if deliveries.seen_delivery(delivery):
+        return {'statusCode': '200', 'body': '{}'}
+
+    queue = get_queue()
+    if queue is not None:
+        queue.send(pack_message(event['body'], delivery))
+        return {'statusCode': '202', 'body': '{}'}
+
+    process_push(json.loads(event['body']), delivery, context)
+
+    return {'statusCode': '200', 'body': '{}'}
+
+
+@raven_handler
+@metrics.flushing
+def github_worker_handler(event, context):
+    """
+    Scans github pushes queued by `github_handler`.
+
+    When triggered by SQS the records of the event are processed and failed records
+    are reported back so only they are retried. A `continuation` event carries the rest
+    of a push an invocation ran out of time for. Otherwise, e.g. on a schedule, the
+    configured queue is drained in batches.
+    """
+    if event.get('continuation'):
+        process_message(event['continuation'], context)
+        return {'statusCode': '200', 'body': '{}'}
+
+    if event.get('Records'):
+        failures = []
+
+        for r in event['Records']:
+            # leave records we have no time for to be redelivered
+            if out_of_time(context):
+                failures.append({'itemIdentifier': r['messageId']})
+                continue
+
+            try:
+                process_message(json.loads(r['body']), context)
+            except Exception as e:
+                log.exception(e)
+                failures.append({'itemIdentifier': r['messageId']})
+
+        return {'batchItemFailures': failures}
+
+    queue = get_queue()
+    if queue is None:
+        log.error('No queue configured to drain. Set SPILLGUARD_QUEUE_URL or SPILLGUARD_QUEUE_PATH.')
+        return {'statusCode': '200', 'body': '{}'}
 
-    for c in body['commits']:
-        commit_data = github.request(commit_url + '/' + c['id'])
+    while not out_of_time(context):
+        messages = queue.receive(QUEUE_BATCH_SIZE)
+        if not messages:
+            break
 
-        for f in commit_data['files']:
-            data = github.request(blobs_url + '/' + f['sha'])['content']
+        for receipt, message in messages:
             try:
-                commit_data['contents'] = base64.b64decode(data).decode('utf-8', 'ignore')
-                commit_data['contents_url'] = f['contents_url']
-                commit_data['committer'] = c['committer']
-                commit_data['ref'] = body['ref']
-                commit_data['html_url'] = body['repository']['html_url']
+                process_message(message, context)
             except Exception as e:
                 log.exception(e)
                 continue
 
-            process_task_configs(commit_data, config)
+            queue.delete(receipt)
 
     return {'statusCode': '200', 'body': '{}'}
 
 
-@RavenLambdaWrapper()
+def stash_message(r):
+    """Return the message id and stash event of an SNS record, or of an SQS record subscribed to SNS."""
+    if 'Sns' in r:
+        return r['Sns']['MessageId'], json.loads(r['Sns']['Message'])
+
+    return r['messageId'], json.loads(json.loads(r['body'])['Message'])
+
+
+def stash_repository(body):
+    """Return the url of the repository a stash commit event belongs to."""
+    return body['source']['url'].split('/commits/')[0]
+
+
+def normalize_stash_commit(body, file_url, contents, blob_hits=None):
+    """Combine stash commit and file information into the commit data we analyze."""
+    return {
+        'contents': contents,
+        'blob_hits': blob_hits,
+        'contents_url': file_url,
+        'sha': body['source']['sha'],
+        'committer': body['source']['author']['email'],
+        'ref': body['source']['refId'],
+        'html_url': body['source']['url']
+    }
+
+
+def scan_stash_file(scanner, file_url):
+    """Stream a stash file into the scanner, so only a chunk of it is held at a time."""
+    metrics.incr('FilesScanned')
+    return scanner.scan_chunks(bitbucket.stream_contents(file_url), overlap=blobs.SCAN_OVERLAP)
+
+
+def fetch_stash_changes(url):
+    """Fetch the changes of a stash commit."""
+    with metrics.timer('CommitFetch'):
+        return bitbucket.get_changes(url)
+
+
+def fetch_stash_files(commits, scanner, concurrency=BITBUCKET_CONCURRENCY):
+    """Fetch the changes of stash commits and scan their files concurrently.
+
+    Yields ('file', body, commit_data) for each scanned file, ('done', body, None) once all
+    files of a commit were yielded and ('error', body, exception) if a commit failed.
+    """
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, cancelling() as pending:
+        remaining = {}
+        failed = set()
+
+        for body in commits:
+            future = executor.submit(fetch_stash_changes, body['source']['url'] + '/' + 'changes')
+            pending[future] = (body, None)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                body, file_url = pending.pop(future)
+                sha = body['source']['sha']
+
+                if sha in failed:
+                    continue
+
+                try:
+                    result = future.result()
+                except Exception as e:
+                    failed.add(sha)
+                    yield 'error', body, e
+                    continue
+
+                if file_url is None:
+                    remaining[sha] = len(result)
+                    for f in result:
+                        file_url = bitbucket.get_file_url(f['links']['self'][0]['href'])
+                        pending[executor.submit(scan_stash_file, scanner, file_url)] = (body, file_url)
+                else:
+                    remaining[sha] -= 1
+                    yield 'file', body, normalize_stash_commit(body, file_url, None, result)
+
+                if not remaining[sha]:
+                    yield 'done', body, None
+
+
+def merge_results(results, other):
+    """Merge the results collected for one commit into the results of a batch.
+
+    Each commit's entry in `findings` keeps its own ref, committer and url, the `commit`
+    of a merged result only describes the first of them.
+    """
+    for task_id, result in other.items():
+        if task_id in results:
+            results[task_id]['findings'].extend(result['findings'])
+        else:
+            results[task_id] = result
+
+
+def batch_failures(event, failures):
+    """Report the failed records of a batch in the way its trigger retries them.
+
+    SQS retries only the records listed in `batchItemFailures`. SNS and asynchronous
+    invocations ignore the response, so the invocation raises to be retried instead.
+    """
+    if failures and any('Sns' in r for r in event['Records']):
+        raise GeneralFailure('Failed to process records. Messages: {0}'.format(
+            ', '.join(str(f['itemIdentifier']) for f in failures)))
+
+    return {'batchItemFailures': failures}
+
+
+@raven_handler
+@metrics.flushing
 def rocketci_handler(event, context):
     """
     Handles processing of RocketCI commit events.
@@ -185,39 +910,102 @@ def rocketci_handler(event, context):
     5) Analyze blob with terms defined by the Scumblr configuration.
     6) Return analysis results to Scumblr.
 
+    Records are deduplicated by commit and grouped by repository, with one scumblr
+    submission per task and repository. Records from SQS that fail are reported as
+    `batchItemFailures` so only they are retried, SNS records that fail make the
+    invocation raise so it is retried.
+
     :param event:
     :param context:
     :return:
     """
-    log.debug('Entering lambda handler with event: {}'.format(json.dumps(event, indent=2)))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('Entering lambda handler with event: {}'.format(json.dumps(event, indent=2)))
+
+    failures = []
+    records = OrderedDict()
+    commits = OrderedDict()
+
     for r in event['Records']:
-        body = json.loads(r['Sns']['Message'])
-        if body.get('eventSource') == 'stash-stable':
-            if body.get('codeEventType') == 'create_commit':
-                # get search terms from scumblr
-                log.debug('Got Message: {}'.format(json.dumps(body, indent=2)))
-                config = scumblr.get_config('GithubEventAnalyzer')  # TODO separate out terms
-                commit_data = bitbucket.request(body['source']['url'] + '/' + 'changes')
-
-                for f in commit_data['values']:
-                    file_url = bitbucket.get_file_url(f['links']['self'][0]['href'])
-                    data = bitbucket.reconstruct_contents(bitbucket.request(file_url))
-
-                    # normalize commit data
-                    commit_data['contents'] = data
-                    commit_data['contents_url'] = file_url
-                    commit_data['sha'] = body['source']['sha']
-                    commit_data['committer'] = body['source']['author']['email']
-                    commit_data['ref'] = body['source']['refId']
-                    commit_data['html_url'] = body['source']['url']
-
-                    # send to scumblr
-                    process_task_configs(commit_data, config)
+        try:
+            message_id, body = stash_message(r)
+        except Exception as e:
+            log.exception(e)
+            failures.append({'itemIdentifier': r.get('messageId') or r.get('Sns', {}).get('MessageId')})
+            continue
 
-    return {'statusCode': '200', 'body': '{}'}
+        if body.get('eventSource') == 'stash-stable' and body.get('codeEventType') == 'create_commit':
+            sha = body['source']['sha']
+            records.setdefault(sha, []).append((message_id, r))
+            commits.setdefault(sha, body)
+
+    if not commits:
+        return batch_failures(event, failures)
+
+    # get search terms from scumblr
+    with metrics.timer('ConfigFetch'):
+        config = scumblr.get_config('GithubEventAnalyzer')  # TODO separate out terms
+
+    repositories = OrderedDict()
+    for body in commits.values():
+        repositories.setdefault(stash_repository(body), []).append(body)
+
+    log.debug('Batch contains {0} commits in {1} repositories'.format(len(commits), len(repositories)))
+
+    def fail(bodies):
+        for body in bodies:
+            for message_id, _ in records[body['source']['sha']]:
+                if {'itemIdentifier': message_id} not in failures:
+                    failures.append({'itemIdentifier': message_id})
+
+    for i, (repository, bodies) in enumerate(repositories.items()):
+        if out_of_time(context):
+            remaining = [b for group in list(repositories.values())[i:] for b in group]
+            records_left = [r for b in remaining for _, r in records[b['source']['sha']]]
+
+            # sns records can't be retried one by one, hand them to a new invocation instead
+            sns = [r for r in records_left if 'Sns' in r]
+            if sns:
+                invoke_async(context.invoked_function_arn, {'Records': sns})
+
+            failures.extend({'itemIdentifier': r['messageId']} for r in records_left if 'Sns' not in r)
+            break
+
+        results = {}
+        commit_results = {}
+        failed = set()
+
+        for kind, body, data in fetch_stash_files(bodies, get_task_scanner(config)):
+            sha = body['source']['sha']
+            if sha in failed:
+                continue
+
+            try:
+                if kind == 'error':
+                    raise data
+
+                if kind == 'file':
+                    process_task_configs(data, config, commit_results.setdefault(sha, {}))
+                else:
+                    merge_results(results, commit_results.pop(sha, {}))
+            except Exception as e:
+                log.exception(e)
+                failed.add(sha)
+                commit_results.pop(sha, None)
+                fail([body])
+
+        # send to scumblr
+        report_quarantined(config)
+        try:
+            send_task_results(results)
+        except Exception as e:
+            log.exception(e)
+            fail(bodies)
+
+    return batch_failures(event, failures)
 
 
-@RavenLambdaWrapper()
+@raven_handler
 def bitbucket_handler(event, context):
     """
     Handles processing of bitbucket commit events.
@@ -0,0 +1,177 @@
+import os
+import sys
+import json
+import time
+import functools
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+
+from scumblr_spillguard import log
+
+# where metrics are written: 'emf' prints cloudwatch embedded metric format lines, 'json'
+# appends plain json lines to SPILLGUARD_METRICS_PATH, anything else turns them off
+METRICS_SINK = os.environ.get('SPILLGUARD_METRICS', 'emf')
+METRICS_PATH = os.environ.get('SPILLGUARD_METRICS_PATH', '/tmp/spillguard-metrics.jsonl')
+METRICS_NAMESPACE = os.environ.get('SPILLGUARD_METRICS_NAMESPACE', 'ScumblrSpillguard')
+# time every term pattern on its own, costs a timer call per pattern per file
+TERM_TIMING = os.environ.get('SPILLGUARD_TERM_TIMING', '').lower() in ('1', 'true', 'yes')
+
+STAGES = ('Validate', 'ConfigFetch', 'CommitFetch', 'BlobFetch', 'Decode', 'Scan', 'Submit')
+
+
+class NullTimer(object):
+    """Stands in for a timer when nothing is timed."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics(object):
+    """Stage timings, counters and per term match times recorded during an invocation.
+
+    Stages run on several threads at once, so their times add up the time spent in
+    each stage by all threads rather than wall time of the invocation.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.timings = defaultdict(float)
+            self.counts = defaultdict(int)
+            self.terms = defaultdict(float)
+
+    def add_time(self, stage, ms):
+        with self.lock:
+            self.timings[stage] += ms
+            self.counts[stage] += 1
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counts[name] += value
+
+    def add_term_time(self, pattern, ms):
+        with self.lock:
+            self.terms[pattern] += ms
+
+    @contextmanager
+    def timer(self, stage):
+        """Time a block of work as part of stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, (time.perf_counter() - start) * 1000)
+
+    def term_timer(self, pattern):
+        """Time matching a term pattern if TERM_TIMING is on, otherwise do nothing."""
+        if not TERM_TIMING:
+            return NULL_TIMER
+        return self.time_term(pattern)
+
+    @contextmanager
+    def time_term(self, pattern):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_term_time(pattern, (time.perf_counter() - start) * 1000)
+
+    def snapshot(self):
+        """Return what was recorded as flat metric values."""
+        with self.lock:
+            values = {}
+
+            for stage, ms in self.timings.items():
+                values[stage + 'Time'] = round(ms, 3)
+
+            for name, count in self.counts.items():
+                values[name + 'Count' if name in self.timings else name] = count
+
+                if name.endswith('Hits'):
+                    misses = self.counts.get(name[:-len('Hits')] + 'Misses', 0)
+                    values[name[:-len('Hits')] + 'HitRate'] = round(count / float(count + misses), 4)
+
+            terms = dict((p, round(ms, 3)) for p, ms in self.terms.items())
+
+        return values, terms
+
+
+metrics = Metrics()
+
+timer = metrics.timer
+incr = metrics.incr
+
+
+def unit(name):
+    if name.endswith('Time'):
+        return 'Milliseconds'
+    if name.endswith('Bytes'):
+        return 'Bytes'
+    if name.endswith('Rate'):
+        return 'None'
+    return 'Count'
+
+
+def emf_record(function, values, terms):
+    """Build a cloudwatch embedded metric format record.
+
+    Per term times are kept as properties rather than metrics, they can be queried
+    with logs insights without creating a metric for every pattern.
+    """
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Function']],
+                'Metrics': [{'Name': name, 'Unit': unit(name)} for name in sorted(values)]
+            }]
+        },
+        'Function': function
+    }
+    record.update(values)
+
+    if terms:
+        record['TermTimes'] = terms
+
+    return record
+
+
+def flush(function):
+    """Write and reset the metrics recorded for an invocation of function."""
+    values, terms = metrics.snapshot()
+    metrics.reset()
+
+    if not values or METRICS_SINK not in ('emf', 'json'):
+        return
+
+    try:
+        if METRICS_SINK == 'emf':
+            sys.stdout.write(json.dumps(emf_record(function, values, terms)) + '\n')
+            sys.stdout.flush()
+        else:
+            record = dict(values, Function=function, Timestamp=int(time.time() * 1000), TermTimes=terms)
+            with open(METRICS_PATH, 'a') as f:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+    except Exception as e:
+        log.exception(e)
+
+
+def flushing(func):
+    """Flush the metrics of a lambda handler once it returns or raises."""
+    @functools.wraps(func)
+    def handler(event, context):
+        try:
+            return func(event, context)
+        finally:
+            flush(func.__name__)
+
+    return handler
@@ -0,0 +1,226 @@
+"""
+Profiles the cost of scumblr term patterns before they go live.
+
+Every pattern is timed against inputs of growing size that tend to trip up regex
+backtracking, and optionally against a corpus of real files. Patterns whose time grows
+faster than linearly with the input, or that run past their budget, are flagged::
+
+    python -m scumblr_spillguard.profiler --terms terms.json --corpus src/*.py
+
+Exits with a non zero status if any pattern is flagged.
+"""
+import sys
+import json
+import math
+import argparse
+from collections import OrderedDict
+
+from scumblr_spillguard import guard
+from scumblr_spillguard.scanner import FLAGS, is_literal
+
+# input sizes in characters each pattern is timed at
+PROFILE_SIZES = (1024, 4096, 16384)
+# growth exponent above which a pattern is considered super-linear, 1 is linear
+SUPERLINEAR_EXPONENT = 1.5
+# times below this many seconds are too noisy to estimate growth from
+NOISE_FLOOR = 0.0005
+
+# strings that are repeated to make the adversarial inputs, each followed by a character
+# that makes the match fail at the very end, along with pumps made from the pattern itself
+PUMPS = OrderedDict([
+    ('letters', 'a'),
+    ('digits', '1'),
+    ('spaces', ' '),
+    ('alnum', 'aB3'),
+    ('words', 'word '),
+    ('base64', 'QUJDRA=='),
+    ('hex', 'deadbeef'),
+    ('symbols', '-_.=/+'),
+    ('lines', 'key = value\n'),
+    ('quotes', '"\'')
+])
+
+
+def repeated_chars(items, repeated=False, chars=None):
+    """Collect a character matched by each repeated element of a parsed pattern."""
+    sre_constants = guard.sre_constants
+    chars = [] if chars is None else chars
+
+    for op, av in items:
+        if op == sre_constants.LITERAL and repeated:
+            chars.append(chr(av))
+        elif op == sre_constants.IN and repeated:
+            for member_op, member in av:
+                if member_op == sre_constants.LITERAL:
+                    chars.append(chr(member))
+                    break
+                if member_op == sre_constants.RANGE:
+                    chars.append(chr(member[0]))
+                    break
+        elif op in guard.REPEATS:
+            repeated_chars(av[2], repeated or av[1] > 1, chars)
+        elif op == sre_constants.SUBPATTERN:
+            repeated_chars(av[-1], repeated, chars)
+        elif op == sre_constants.BRANCH:
+            for branch in av[1]:
+                repeated_chars(branch, repeated, chars)
+
+    return chars
+
+
+def pattern_pumps(pattern):
+    """Pumps made of the characters the pattern's own repeats accept."""
+    try:
+        chars = list(OrderedDict.fromkeys(repeated_chars(guard.sre_parse.parse(pattern))))
+    except Exception:
+        return OrderedDict()
+
+    pumps = OrderedDict(('char {0!r}'.format(c), c) for c in chars[:8])
+    if len(chars) > 1:
+        pumps['chars'] = ''.join(chars[:8])
+    return pumps
+
+
+def adversarial_input(pump, size):
+    return (pump * (size // len(pump) + 1))[:size] + '!'
+
+
+def exponent(sizes, times):
+    """Estimate how time grows with input size between the two largest sizes."""
+    if times[-1] is None:
+        return float('inf')
+
+    if times[-1] < NOISE_FLOOR or not times[-2]:
+        return 1.0
+
+    return math.log(times[-1] / times[-2]) / math.log(float(sizes[-1]) / sizes[-2])
+
+
+def profile_pattern(pattern, sizes=PROFILE_SIZES, corpus=(), budget=None):
+    """Time a pattern against the adversarial inputs and a corpus, returning a report."""
+    import re
+
+    budget = guard.PATTERN_BUDGET if budget is None else budget
+    report = OrderedDict([('pattern', pattern), ('verdict', 'ok'), ('exponent', 1.0), ('worst_input', None)])
+
+    try:
+        compiled = re.compile(pattern, FLAGS)
+    except re.error as e:
+        report['verdict'] = 'invalid'
+        report['error'] = str(e)
+        return report
+
+    report['risky'] = guard.is_risky(pattern)
+
+    if is_literal(pattern):
+        return report
+
+    worker = guard.Worker()
+    try:
+        worst = 1.0
+        times = OrderedDict()
+
+        pumps = OrderedDict(PUMPS)
+        pumps.update(pattern_pumps(pattern))
+
+        for name, pump in pumps.items():
+            timed = []
+            for size in sizes:
+                try:
+                    timed.append(worker.search(compiled, adversarial_input(pump, size), budget)[1])
+                except guard.PatternTimeout:
+                    timed.append(None)
+                    break
+
+            times[name] = [round(t * 1000, 3) if t is not None else None for t in timed]
+            k = exponent(sizes[:len(timed)], timed)
+
+            if k > worst:
+                worst = k
+                report['worst_input'] = name
+
+        report['exponent'] = round(worst, 2) if worst != float('inf') else None
+        report['times_ms'] = times
+
+        corpus_time = 0
+        for contents in corpus:
+            try:
+                corpus_time += worker.search(compiled, contents, budget)[1]
+            except guard.PatternTimeout:
+                corpus_time = None
+                break
+
+        if corpus:
+            report['corpus_ms'] = round(corpus_time * 1000, 3) if corpus_time is not None else None
+
+        if worst == float('inf') or (corpus and corpus_time is None):
+            report['verdict'] = 'timeout'
+        elif worst > SUPERLINEAR_EXPONENT:
+            report['verdict'] = 'superlinear'
+    finally:
+        worker.stop()
+
+    return report
+
+
+def profile_terms(terms, sizes=PROFILE_SIZES, corpus=(), budget=None):
+    """Profile every distinct pattern of a term dictionary, flagged patterns first."""
+    reports = OrderedDict()
+
+    for name, pattern in terms.items():
+        if pattern not in reports:
+            reports[pattern] = profile_pattern(pattern, sizes, corpus, budget)
+            reports[pattern]['terms'] = []
+        reports[pattern]['terms'].append(name)
+
+    return sorted(reports.values(), key=lambda r: r['verdict'] == 'ok')
+
+
+def config_terms(configs):
+    """Flatten scumblr task configs into terms named `task id:term name`."""
+    from scumblr_spillguard.scanner import task_terms
+    return OrderedDict(('{0}:{1}'.format(*key), p) for key, p in task_terms(configs).items())
+
+
+def load_terms(path):
+    """Load terms from a json file, either a {name: pattern} dictionary or a scumblr task config."""
+    with open(path) as f:
+        data = json.load(f)
+
+    if isinstance(data, dict) and all(isinstance(v, str) for v in data.values()):
+        return data
+
+    return config_terms(data)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--terms', help='json terms or task config, defaults to the live scumblr config')
+    parser.add_argument('--corpus', nargs='*', default=[], help='files to time every pattern against')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(PROFILE_SIZES))
+    parser.add_argument('--budget', type=float, default=guard.PATTERN_BUDGET)
+    args = parser.parse_args(argv)
+
+    if args.terms:
+        terms = load_terms(args.terms)
+    else:
+        from scumblr_spillguard import scumblr
+        terms = config_terms(scumblr.get_config('GithubEventAnalyzer'))
+
+    corpus = []
+    for path in args.corpus:
+        with open(path, 'rb') as f:
+            corpus.append(f.read().decode('utf-8', 'replace'))
+
+    reports = profile_terms(terms, args.sizes, corpus, args.budget)
+
+    for report in reports:
+        print(json.dumps(report))
+
+    flagged = [r for r in reports if r['verdict'] != 'ok']
+    sys.stderr.write('{0} patterns profiled, {1} flagged\n'.format(len(reports), len(flagged)))
+    return 1 if flagged else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,166 @@
+import os
+import json
+import uuid
+import time
+import threading
+from collections import OrderedDict
+
+from scumblr_spillguard import log
+
+QUEUE_URL = os.environ.get('SPILLGUARD_QUEUE_URL')
+QUEUE_PATH = os.environ.get('SPILLGUARD_QUEUE_PATH')
+# seconds a message received from a local queue stays hidden before it is delivered again
+VISIBILITY_TIMEOUT = int(os.environ.get('SPILLGUARD_QUEUE_VISIBILITY_TIMEOUT', 900))
+
+_queue = None
+
+
+class Queue(object):
+    """Work queue between the webhook ingest stage and the scan worker."""
+    def send(self, message):
+        """Enqueue a json serializable message."""
+        raise NotImplementedError
+
+    def receive(self, max_messages=10):
+        """Return up to max_messages as a list of (receipt, message) tuples."""
+        raise NotImplementedError
+
+    def delete(self, receipt):
+        """Acknowledge a received message so it is not delivered again."""
+        raise NotImplementedError
+
+
+class SQSQueue(Queue):
+    """Queue backed by AWS SQS."""
+    def __init__(self, url, wait_time=0):
+        import boto3
+        self.url = url
+        self.wait_time = wait_time
+        self.client = boto3.session.Session().client('sqs')
+
+    def send(self, message):
+        self.client.send_message(QueueUrl=self.url, MessageBody=json.dumps(message))
+
+    def receive(self, max_messages=10):
+        response = self.client.receive_message(
+            QueueUrl=self.url,
+            MaxNumberOfMessages=min(max_messages, 10),
+            WaitTimeSeconds=self.wait_time
+        )
+        return [(m['ReceiptHandle'], json.loads(m['Body'])) for m in response.get('Messages', [])]
+
+    def delete(self, receipt):
+        self.client.delete_message(QueueUrl=self.url, ReceiptHandle=receipt)
+
+
+class LocalQueue(Queue):
+    """Queue kept in process, or as json files in a local directory if a path is given.
+
+    Like SQS, a received message that is not deleted within the visibility timeout, e.g.
+    because its worker crashed, is delivered again. Intended for tests and local development.
+    """
+    def __init__(self, path=None, visibility_timeout=VISIBILITY_TIMEOUT):
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.lock = threading.Lock()
+        self.messages = OrderedDict()
+        # messages received from the in process queue, by name, with the time they were received
+        self.inflight = {}
+
+        if path and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def send(self, message):
+        name = '{0:020d}-{1}'.format(int(time.time() * 1e6), uuid.uuid4().hex)
+
+        if not self.path:
+            with self.lock:
+                self.messages[name] = message
+            return
+
+        tmp = os.path.join(self.path, name + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(message, f)
+        os.rename(tmp, os.path.join(self.path, name + '.json'))
+
+    def receive(self, max_messages=10):
+        received = []
+
+        with self.lock:
+            self.reclaim()
+
+            if not self.path:
+                for name in list(self.messages)[:max_messages]:
+                    message = self.messages.pop(name)
+                    self.inflight[name] = (time.time(), message)
+                    received.append((name, message))
+                return received
+
+            for name in sorted(os.listdir(self.path)):
+                if len(received) >= max_messages:
+                    break
+                if not name.endswith('.json'):
+                    continue
+
+                # claim the message so another worker doesn't pick it up, its mtime
+                # records when it was claimed
+                claimed = os.path.join(self.path, name[:-len('.json')] + '.inflight')
+                try:
+                    os.rename(os.path.join(self.path, name), claimed)
+                    os.utime(claimed, None)
+                except OSError:
+                    continue
+
+                with open(claimed) as f:
+                    received.append((claimed, json.load(f)))
+
+        return received
+
+    def reclaim(self):
+        """Make messages claimed longer ago than the visibility timeout available again."""
+        expired = time.time() - self.visibility_timeout
+
+        if not self.path:
+            for name, (claimed, message) in sorted(self.inflight.items()):
+                if claimed < expired:
+                    del self.inflight[name]
+                    self.messages[name] = message
+                    log.info('Redelivering message not deleted in time. Message: {0}'.format(name))
+            return
+
+        for name in os.listdir(self.path):
+            if not name.endswith('.inflight'):
+                continue
+
+            claimed = os.path.join(self.path, name)
+            try:
+                if os.path.getmtime(claimed) < expired:
+                    os.rename(claimed, claimed[:-len('.inflight')] + '.json')
+                    log.info('Redelivering message not deleted in time. Message: {0}'.format(name))
+            except OSError:
+                continue
+
+    def delete(self, receipt):
+        if not self.path:
+            with self.lock:
+                if self.inflight.pop(receipt, None) is None:
+                    log.debug('No message {0}'.format(receipt))
+            return
+
+        try:
+            os.unlink(receipt)
+        except OSError:
+            log.debug('No message {0}'.format(receipt))
+
+
+def get_queue():
+    """Return the configured queue, or None if pushes should be scanned inline."""
+    global _queue
+
+    if _queue is None:
+        if QUEUE_URL:
+            _queue = SQSQueue(QUEUE_URL)
+        elif QUEUE_PATH:
+            _queue = LocalQueue(QUEUE_PATH)
+
+    return _queue
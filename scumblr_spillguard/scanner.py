@@ -0,0 +1,224 @@
+import re
+import json
+import hashlib
+from collections import OrderedDict
+
+from scumblr_spillguard import log, metrics, guard
+
+FLAGS = re.MULTILINE | re.DOTALL
+REGEX_CHARS = set('.^$*+?{}[]\\|()')
+
+# number of compiled scanners kept alive in a warm container
+MAX_CACHED_SCANNERS = 16
+
+_scanners = OrderedDict()
+_task_scanner = (None, None)
+
+
+def is_literal(pattern):
+    """Determine if a pattern can be matched as a plain substring."""
+    return not REGEX_CHARS.intersection(pattern)
+
+
+def terms_hash(terms):
+    """Stable hash of a term dictionary, used as the scanner cache key."""
+    items = sorted([str(k), v] for k, v in terms.items())
+    return hashlib.sha1(json.dumps(items).encode('utf-8')).hexdigest()
+
+
+def is_ascii(pattern):
+    return all(ord(c) < 128 for c in pattern)
+
+
+class Scanner(object):
+    """Matches a set of terms against file contents.
+
+    Literal terms are combined into a single alternation so that they are all
+    found in one pass over the contents, only the real regexes are run separately.
+    Identical patterns are only matched once no matter how many terms use them.
+
+    Contents may be text or raw utf-8 bytes (bytes, bytearray or memoryview), for which every pattern is also compiled
+    to bytes. Regexes with non ascii characters can't be matched byte for byte and are
+    run against a decoded copy, only made if there are any.
+    """
+    def __init__(self, terms):
+        self.hash = terms_hash(terms)
+        self.keys = list(terms.keys())
+        self.owners = OrderedDict()
+
+        for key, pattern in terms.items():
+            self.owners.setdefault(pattern, []).append(key)
+
+        self.literals = [p for p in self.owners if is_literal(p)]
+        self.regexes = []
+        self.byte_regexes = []
+        self.text_regexes = []
+
+        for pattern in self.owners:
+            if is_literal(pattern):
+                continue
+
+            try:
+                compiled = re.compile(pattern, FLAGS)
+            except re.error as e:
+                log.warning('Skipping invalid term pattern. Pattern: {0} Error: {1}'.format(pattern, e))
+                continue
+
+            self.regexes.append((pattern, compiled))
+
+            if is_ascii(pattern):
+                self.byte_regexes.append((pattern, re.compile(pattern.encode('utf-8'), FLAGS)))
+            else:
+                self.text_regexes.append((pattern, compiled))
+
+        self.literal_re = self.byte_literal_re = None
+        self.contained = {}
+
+        if self.literals:
+            # longest first so the alternation reports the longest literal at each position,
+            # any shorter literal found at that position is a substring of it
+            ordered = sorted(self.literals, key=len, reverse=True)
+            self.literal_re = re.compile('|'.join(re.escape(l) for l in ordered))
+            self.byte_literal_re = re.compile(b'|'.join(re.escape(l.encode('utf-8')) for l in ordered))
+            self.contained = {l: [o for o in self.literals if o in l] for l in self.literals}
+            self.contained.update((l.encode('utf-8'), c) for l, c in list(self.contained.items()))
+
+    def match_literals(self, contents):
+        """Find every literal occurring in contents with a single pass."""
+        literal_re = self.literal_re if isinstance(contents, str) else self.byte_literal_re
+        found = set()
+        pos = 0
+
+        while len(found) < len(self.literals):
+            match = literal_re.search(contents, pos)
+            if not match:
+                break
+
+            found.update(self.contained[match.group(0)])
+            pos = match.start() + 1
+
+        return found
+
+    def match(self, contents, literals_only=False, skip=()):
+        """Return the set of patterns that occur in contents, regexes in skip are not run."""
+        with metrics.timer('Scan'):
+            return self.match_patterns(contents, literals_only, skip)
+
+    def match_patterns(self, contents, literals_only=False, skip=()):
+        """Return the set of patterns that occur in contents, regexes in skip are not run.
+
+        With `metrics.TERM_TIMING` on, the time spent on each pattern is recorded.
+        """
+        term_timer = metrics.metrics.term_timer
+        matched = set()
+
+        if self.literal_re is not None:
+            with term_timer('<literals>'):
+                matched.update(self.match_literals(contents))
+
+        if literals_only:
+            return matched
+
+        if isinstance(contents, str):
+            runs = [(self.regexes, contents)]
+        else:
+            runs = [(self.byte_regexes, contents)]
+            if any(p not in skip for p, _ in self.text_regexes):
+                runs.append((self.text_regexes, bytes(contents).decode('utf-8', 'replace')))
+
+        for regexes, target in runs:
+            for pattern, compiled in regexes:
+                if pattern in skip:
+                    continue
+
+                with term_timer(pattern):
+                    if guard.search(pattern, compiled, target):
+                        matched.add(pattern)
+
+        return matched
+
+    def quarantined(self):
+        """Determine if any of our patterns are quarantined, making scan results incomplete."""
+        return any(p in guard.quarantined for p in self.owners)
+
+    def keys_for(self, patterns):
+        """Return the keys of all terms using the given patterns, in term order."""
+        hit = set()
+
+        for pattern in patterns:
+            log.debug('Contents hit on pattern {}'.format(pattern))
+            hit.update(self.owners[pattern])
+
+        return [k for k in self.keys if k in hit]
+
+    def scan(self, contents):
+        """Return the keys of all terms hitting on contents, in term order."""
+        return self.keys_for(self.match(contents))
+
+    def scan_chunks(self, chunks, overlap=4096, literals_only=False):
+        """Scan text or byte chunks as they arrive, only holding one chunk at a time.
+
+        The last overlap characters of each chunk are scanned again with the next one so
+        matches spanning a chunk boundary are found, as long as they are no longer than
+        overlap. Literals are always covered.
+        """
+        overlap = max([overlap] + [len(l.encode('utf-8')) for l in self.literals])
+        total = len(self.literals) + (0 if literals_only else len(self.regexes))
+
+        matched = set()
+        tail = None
+
+        for chunk in chunks:
+            window = chunk if tail is None else tail + chunk
+            matched.update(self.match(window, literals_only=literals_only, skip=matched))
+
+            if len(matched) >= total:
+                break
+
+            tail = window[-overlap:]
+
+        return self.keys_for(matched)
+
+
+def task_terms(configs):
+    """Merge the terms of all task configs, keyed by (task id, term name)."""
+    terms = OrderedDict()
+
+    for config in configs:
+        for name, pattern in config['options']['github_terms'].items():  # todo 'github_terms' should be generic 'terms'
+            terms[(config['id'], name)] = pattern
+
+    return terms
+
+
+def get_scanner(terms):
+    """Return a compiled scanner for terms, reusing one from a previous invocation if possible."""
+    key = terms_hash(terms)
+
+    scanner = _scanners.get(key)
+    if scanner is not None:
+        _scanners.move_to_end(key)
+        return scanner
+
+    log.debug('Compiling scanner for {0} terms. Hash: {1}'.format(len(terms), key))
+    scanner = Scanner(terms)
+    _scanners[key] = scanner
+
+    while len(_scanners) > MAX_CACHED_SCANNERS:
+        _scanners.popitem(last=False)
+
+    return scanner
+
+
+def get_task_scanner(configs):
+    """Return the scanner for a list of task configs.
+
+    The scanner is only rebuilt when scumblr hands us a different configuration object,
+    so the term set is not rehashed for every file.
+    """
+    global _task_scanner
+
+    if _task_scanner[0] is not configs:
+        _task_scanner = (configs, get_scanner(task_terms(configs)))
+
+    return _task_scanner[1]
@@ -1,24 +1,103 @@
 import os
+import gzip
 import json
-import requests
+import time
+import threading
 
-from scumblr_spillguard import log
-from scumblr_spillguard.utils import mktempfile
+from scumblr_spillguard import log, metrics
+from scumblr_spillguard.utils import mktempfile, CircuitBreaker, retry
 from scumblr_spillguard.secrets import get_secret
-from scumblr_spillguard.exceptions import GeneralFailure
+from scumblr_spillguard.sessions import get_session
+from scumblr_spillguard.exceptions import GeneralFailure, UnavailableError
 
 CWD = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 
-SCUMBLR_URL = os.environ["SCUMBLR_URL"]
 SCUMBLR_CLIENT_PATH = os.path.join(CWD, os.environ.get("SCUMBLR_CLIENT_PATH", "SCUMBLR_CLIENT.cert"))
 
+# seconds a task configuration is served from memory before it is revalidated
+CONFIG_TTL = int(os.environ.get("SCUMBLR_CONFIG_TTL", 300))
+# seconds to wait on scumblr when we already have a configuration to fall back on
+CONFIG_TIMEOUT = float(os.environ.get("SCUMBLR_CONFIG_TIMEOUT", 2))
+
+# compress result submissions, scumblr must accept `Content-Encoding: gzip`
+SCUMBLR_GZIP = os.environ.get("SCUMBLR_GZIP", "").lower() in ("1", "true", "yes")
+
+# attempts made for a scumblr request that fails with a connection error or a 5xx
+SCUMBLR_RETRIES = int(os.environ.get("SCUMBLR_RETRIES", 3))
+# milliseconds the exponential backoff between attempts starts from, and is capped at
+SCUMBLR_BACKOFF = int(os.environ.get("SCUMBLR_BACKOFF", 200))
+SCUMBLR_BACKOFF_MAX = int(os.environ.get("SCUMBLR_BACKOFF_MAX", 2000))
+# consecutive failures before we stop calling scumblr, and seconds before we try again
+SCUMBLR_CIRCUIT_THRESHOLD = int(os.environ.get("SCUMBLR_CIRCUIT_THRESHOLD", 5))
+SCUMBLR_CIRCUIT_RESET = float(os.environ.get("SCUMBLR_CIRCUIT_RESET", 30))
+
+CONFIG_URL = '/tasks/search?q[task_type_eq]=ScumblrTask::{0}&resolve_system_metadata=true'
+
+_configs = {}
+config_stats = {'hits': 0, 'misses': 0, 'revalidated': 0, 'stale': 0}
+
+circuit = CircuitBreaker('scumblr', SCUMBLR_CIRCUIT_THRESHOLD, SCUMBLR_CIRCUIT_RESET)
+
+_ssl_context = None
+_ssl_lock = threading.Lock()
+
 
 def get_config(name):
-    """Return the current scumblr task configuration."""
-    return request(
-        '/tasks/search?q[task_type_eq]=ScumblrTask::{0}&resolve_system_metadata=true'.format(
-            name
-        ))
+    """Return the current scumblr task configuration.
+
+    Configurations are kept for the lifetime of the container and revalidated once
+    they are older than `SCUMBLR_CONFIG_TTL`. The last good configuration is served
+    if scumblr fails to respond.
+    """
+    cached = _configs.get(name)
+    now = time.time()
+
+    if cached and now - cached['fetched'] < CONFIG_TTL:
+        config_stats['hits'] += 1
+        metrics.incr('ConfigCacheHits')
+        return cached['config']
+
+    config_stats['misses'] += 1
+    metrics.incr('ConfigCacheMisses')
+
+    headers = {}
+    if cached and cached['etag']:
+        headers['If-None-Match'] = cached['etag']
+
+    import requests
+
+    try:
+        response = fetch(CONFIG_URL.format(name), headers=headers, timeout=CONFIG_TIMEOUT if cached else None)
+    except (GeneralFailure, requests.RequestException) as e:
+        if not cached:
+            raise
+
+        log.warning('Unable to refresh scumblr config, serving last good config. Name: {0} Error: {1}'.format(name, e))
+        config_stats['stale'] += 1
+        cached['fetched'] = now
+        return cached['config']
+
+    if response.status_code == 304:
+        config_stats['revalidated'] += 1
+        cached['fetched'] = now
+        return cached['config']
+
+    config = response.json()
+
+    # keep the previous object when nothing changed so compiled scanners are reused
+    if cached and config == cached['config']:
+        config = cached['config']
+
+    _configs[name] = {'config': config, 'etag': response.headers.get('ETag'), 'fetched': now}
+    return config
+
+
+def invalidate_config(name=None):
+    """Drop cached task configurations, forcing the next lookup to hit scumblr."""
+    if name:
+        _configs.pop(name, None)
+    else:
+        _configs.clear()
 
 
 def send_results(results):
@@ -27,30 +106,107 @@ def send_results(results):
         '/tasks/{task_id}/run'.format(task_id=results['task_id']), data=results)
 
 
-# TODO add retry logic here too?
+def get_url():
+    """The scumblr base url, read when it is first needed so importing us needs no configuration."""
+    return os.environ["SCUMBLR_URL"]
+
+
+def get_ssl_context():
+    """Return the TLS context holding our scumblr client certificate.
+
+    The certificate and decrypted key are loaded once per container. The key only
+    touches disk for as long as it takes to load it, in a temp file only we can read.
+    """
+    global _ssl_context
+
+    if _ssl_context is None:
+        with _ssl_lock:
+            if _ssl_context is None:
+                import ssl
+                context = ssl.create_default_context()
+                with mktempfile() as tmpfile:
+                    with open(tmpfile, 'w') as f:
+                        f.write(get_secret("ENCRYPTED_SCUMBLR_KEY").decode('utf-8'))
+                    context.load_cert_chain(SCUMBLR_CLIENT_PATH, tmpfile)
+                _ssl_context = context
+
+    return _ssl_context
+
+
+def get_scumblr_session():
+    """Return the keep-alive session used for scumblr, retries are handled by `fetch`.
+
+    It has a key of its own, a session created for the same host by anyone else would
+    lack the client certificate and retry on its own.
+    """
+    url = get_url()
+    return get_session(url, key='scumblr:{0}'.format(url), retries=0, ssl_context=get_ssl_context())
+
+
+def scumblr_unavailable(exception):
+    """We should retry if scumblr or the network failed, but not if it rejected the request."""
+    import requests
+    log.warning('Scumblr request failed. Error: {0}'.format(exception))
+    return isinstance(exception, (UnavailableError, requests.ConnectionError, requests.Timeout))
+
+
 def request(url, data=None):
     """Attempt to make a scumblr request."""
-    with mktempfile() as tmpfile:
-        with open(tmpfile, 'w') as f:
-            f.write(get_secret("ENCRYPTED_SCUMBLR_KEY").decode('utf-8'))
+    response = fetch(url, data=data)
 
-        if data:
-            data = json.dumps(data, indent=2)
-            log.debug("Scumblr Request. URL: {0} Data: {1}".format(
-                url,
-                data
-            ))
+    if not data:
+        return response.json()
+
+
+@retry(retry_on_exception=scumblr_unavailable, stop_max_attempt_number=SCUMBLR_RETRIES,
+       wait_exponential_multiplier=SCUMBLR_BACKOFF, wait_exponential_max=SCUMBLR_BACKOFF_MAX)
+def fetch(url, data=None, headers=None, timeout=None):
+    """Make a scumblr request, returning the raw response.
+
+    Requests are retried with exponential backoff if scumblr is unavailable, and not
+    made at all while repeated failures hold the circuit open.
+    """
+    import requests
 
-            response = requests.post(SCUMBLR_URL + url, cert=(
-                SCUMBLR_CLIENT_PATH,
-                tmpfile), data=data)
+    circuit.check()
+    session = get_scumblr_session()
+    base_url = get_url()
+
+    if data:
+        data = json.dumps(data, separators=(',', ':'))
+        log.debug("Scumblr Request. URL: {0} Data: {1}".format(
+            url,
+            data
+        ))
+
+        if SCUMBLR_GZIP:
+            data = gzip.compress(data.encode('utf-8'))
+            headers = dict(headers or {}, **{'Content-Encoding': 'gzip'})
+
+    try:
+        if data:
+            response = session.post(base_url + url, data=data, headers=headers, timeout=timeout)
         else:
             log.debug("Scumblr Request. URL: {0}".format(
                 url
             ))
-            response = requests.get(SCUMBLR_URL + url, cert=(
-                SCUMBLR_CLIENT_PATH,
-                tmpfile))
+            response = session.get(base_url + url, headers=headers, timeout=timeout)
+    except requests.RequestException:
+        circuit.failure()
+        raise
+
+    if response.status_code >= 500:
+        circuit.failure()
+        log.debug(response.content)
+        raise UnavailableError("Scumblr unavailable. URL: {0} Status: {1}".format(
+            url, response.status_code
+        ))
+
+    circuit.success()
+
+    if response.status_code == 304:
+        log.debug("Scumblr Response. Status: 304")
+        return response
 
     if not response.ok:
         log.debug(response.content)
@@ -62,6 +218,4 @@ def request(url, data=None):
         response.status_code,
     ))
 
-    if not data:
-        return response.json()
-
+    return response
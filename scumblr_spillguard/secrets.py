@@ -1,11 +1,66 @@
 import os
 import base64
-import boto3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 from scumblr_spillguard import log
 
+SECRET_PREFIX = 'ENCRYPTED_'
 
-def get_secret(name):
-    """Retrieves secret from KMS using the name env variable."""
+_kms = None
+_secrets = {}
+_lock = threading.Lock()
+
+
+def get_kms():
+    """Return the KMS client shared by all secret lookups in this container."""
+    global _kms
+
+    with _lock:
+        if _kms is None:
+            import boto3
+            _kms = boto3.session.Session().client("kms")
+
+    return _kms
+
+
+def decrypt(name):
+    """Decrypts the secret stored in the name env variable."""
     log.info('Fetching secret from env var. VAR: {}'.format(name))
-    kms = boto3.session.Session().client("kms")
-    return kms.decrypt(CiphertextBlob=base64.b64decode(os.environ[name]))["Plaintext"]
+    return get_kms().decrypt(CiphertextBlob=base64.b64decode(os.environ[name]))["Plaintext"]
+
+
+def get_secret(name):
+    """Retrieves secret from KMS using the name env variable.
+
+    Secrets are decrypted once and kept for the lifetime of the container.
+    """
+    secret = _secrets.get(name)
+
+    if secret is None:
+        secret = decrypt(name)
+        _secrets[name] = secret
+
+    return secret
+
+
+def prefetch(names=None, max_workers=4):
+    """Decrypts all configured secrets concurrently, by default every `ENCRYPTED_*` env variable."""
+    if names is None:
+        names = [n for n in os.environ if n.startswith(SECRET_PREFIX)]
+
+    names = [n for n in names if n not in _secrets]
+    if not names:
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for name, secret in zip(names, executor.map(decrypt, names)):
+            _secrets[name] = secret
+
+
+def invalidate(name=None):
+    """Forget decrypted secrets so they are fetched from KMS again, e.g. after a key rotation."""
+    if name:
+        _secrets.pop(name, None)
+    else:
+        _secrets.clear()
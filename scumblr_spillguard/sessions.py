@@ -0,0 +1,76 @@
+import os
+import threading
+from urllib.parse import urlsplit
+
+from scumblr_spillguard import log
+
+POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', 4))
+POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 16))
+TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', 10))
+RETRIES = int(os.environ.get('HTTP_RETRIES', 3))
+BACKOFF_FACTOR = float(os.environ.get('HTTP_BACKOFF_FACTOR', 0.3))
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def get_host(url):
+    """Returns the scheme and host a url points to."""
+    parts = urlsplit(url)
+    return '{0}://{1}'.format(parts.scheme, parts.netloc)
+
+
+def get_session(url, key=None, **kwargs):
+    """Return the session for the host of url, shared across warm invocations.
+
+    Keyword arguments are passed to the `transport.Session` when it is first created, a
+    session configured differently from the host's default needs its own key.
+    """
+    key = key or get_host(url)
+    session = _sessions.get(key)
+
+    if session is None:
+        with _lock:
+            session = _sessions.get(key)
+            if session is None:
+                # requests is only imported once we actually talk to something
+                from scumblr_spillguard.transport import Session
+
+                log.debug('Creating HTTP session. Session: {0}'.format(key))
+                session = Session(**kwargs)
+                _sessions[key] = session
+
+    return session
+
+
+def stats():
+    """Report how many requests were served by how many connections, per session."""
+    report = {}
+
+    for key, session in _sessions.items():
+        connections = requests_made = 0
+
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for pool_key in pools.keys():
+                pool = pools[pool_key]
+                if pool is None:
+                    continue
+                connections += pool.num_connections
+                requests_made += pool.num_requests
+
+        report[key] = {
+            'connections': connections,
+            'requests': requests_made,
+            'reused': max(requests_made - connections, 0)
+        }
+
+    return report
+
+
+def close():
+    """Close all pooled connections."""
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
@@ -0,0 +1,56 @@
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from scumblr_spillguard.sessions import POOL_CONNECTIONS, POOL_MAXSIZE, TIMEOUT, RETRIES, BACKOFF_FACTOR
+
+
+class SSLContextAdapter(HTTPAdapter):
+    """An adapter whose connections are made with a prepared `ssl.SSLContext`.
+
+    Client certificates loaded into the context once are reused by every connection,
+    instead of being read from disk each time a connection is made.
+    """
+    def __init__(self, ssl_context, **kwargs):
+        self.ssl_context = ssl_context
+        super(SSLContextAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.ssl_context
+        return super(SSLContextAdapter, self).init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.ssl_context
+        return super(SSLContextAdapter, self).proxy_manager_for(*args, **kwargs)
+
+
+class Session(requests.Session):
+    """A keep-alive session that applies a default timeout to every request."""
+    def __init__(self, timeout=TIMEOUT, retries=RETRIES, ssl_context=None):
+        super(Session, self).__init__()
+        self.timeout = timeout
+
+        adapter_class = HTTPAdapter
+        adapter_kwargs = {}
+        if ssl_context is not None:
+            adapter_class = SSLContextAdapter
+            adapter_kwargs['ssl_context'] = ssl_context
+
+        adapter = adapter_class(
+            pool_connections=POOL_CONNECTIONS,
+            pool_maxsize=POOL_MAXSIZE,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=BACKOFF_FACTOR,
+                status_forcelist=(500, 502, 503, 504),
+                raise_on_status=False
+            ),
+            **adapter_kwargs
+        )
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(Session, self).request(method, url, **kwargs)
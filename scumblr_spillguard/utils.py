@@ -1,23 +1,159 @@
 import os
+import json
+import time
+import bisect
 import tempfile
-import ipaddress
+import threading
+import functools
 from contextlib import contextmanager
 
 from scumblr_spillguard import log
-from scumblr_spillguard.exceptions import AuthorizationError
+from scumblr_spillguard.exceptions import AuthorizationError, CircuitOpenError
+
+
+class CIDRIndex(object):
+    """IPv4 and IPv6 networks stored as sorted, merged integer ranges.
+
+    Membership is a bisect over the ranges, so lookups stay O(log n) however many
+    networks are added.
+    """
+    def __init__(self, cidrs):
+        import ipaddress
+
+        self.cidrs = list(cidrs)
+        self.ranges = {4: ([], []), 6: ([], [])}
+
+        networks = [ipaddress.ip_network(c, strict=False) for c in self.cidrs]
+
+        for version, (starts, ends) in self.ranges.items():
+            spans = sorted(
+                (int(n.network_address), int(n.broadcast_address)) for n in networks if n.version == version)
+
+            for start, end in spans:
+                if ends and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+
+    def __contains__(self, ip):
+        import ipaddress
+
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+
+        starts, ends = self.ranges[address.version]
+        i = bisect.bisect_right(starts, int(address)) - 1
+        return i >= 0 and int(address) <= ends[i]
+
+
+_indexes = {}
 
 
 def validate_ip(source_ip, whitelist):
-    """Determine if we are getting a request from a whitelisted ip."""
-    log.debug("Validating source IP")
-    for cidr in whitelist:
-        if ipaddress.IPv4Address(source_ip) in ipaddress.IPv4Network(cidr):
-            log.debug("{} is in {}".format(source_ip, cidr))
-            return True
-        else:
-            log.debug("{} is NOT in {}".format(source_ip, cidr))
+    """Determine if we are getting a request from a whitelisted ip.
+
+    The whitelist is either a `CIDRIndex` or a list of cidrs, which is indexed once per container.
+    """
+    if not isinstance(whitelist, CIDRIndex):
+        key = tuple(whitelist)
+        if key not in _indexes:
+            _indexes[key] = CIDRIndex(whitelist)
+        whitelist = _indexes[key]
+
+    if source_ip in whitelist:
+        log.debug("{} is whitelisted".format(source_ip))
+        return True
+
+    raise AuthorizationError('{} is not whitelisted'.format(source_ip))
+
+
+class CircuitBreaker(object):
+    """Stops calls to a failing dependency for a while after repeated failures.
+
+    After `threshold` consecutive failures the circuit opens and calls fail fast with
+    `CircuitOpenError` for `reset_timeout` seconds. The first call after that is let
+    through as a trial, closing the circuit if it succeeds.
+    """
+    def __init__(self, name, threshold=5, reset_timeout=30):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def check(self):
+        """Raise if the circuit is open."""
+        with self.lock:
+            if self.opened is None:
+                return
 
-    raise AuthorizationError()
+            if time.time() - self.opened < self.reset_timeout:
+                raise CircuitOpenError('Circuit open, not calling {0}'.format(self.name))
+
+            # half open, let this call through and wait for it to report back
+            self.opened = time.time()
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened is None:
+                    log.warning('Opening circuit. Name: {0} Failures: {1}'.format(self.name, self.failures))
+                self.opened = time.time()
+
+
+def retry(**options):
+    """Same as `retrying.retry`, but retrying is only imported when the function is first called."""
+    def decorator(func):
+        wrapped = []
+
+        @functools.wraps(func)
+        def call(*args, **kwargs):
+            if not wrapped:
+                from retrying import retry as retrying
+                wrapped.append(retrying(**options)(func))
+
+            return wrapped[0](*args, **kwargs)
+
+        return call
+
+    return decorator
+
+
+def is_prewarm(event):
+    """Determine if an event is a scheduled prewarm rather than real work."""
+    return isinstance(event, dict) and event.get('source') == 'aws.events'
+
+
+def raven_handler(func):
+    """Report a lambda handler's errors, logs, timeouts and memory warnings to sentry.
+
+    The `RavenLambdaWrapper` is built on the first invocation rather than at import, and
+    prewarm events are answered without loading it at all.
+    """
+    wrapped = []
+
+    @functools.wraps(func)
+    def handler(event, context):
+        if is_prewarm(event):
+            return func(event, context)
+
+        if not wrapped:
+            from raven_python_lambda import RavenLambdaWrapper
+            wrapped.append(RavenLambdaWrapper()(func))
+
+        return wrapped[0](event, context)
+
+    return handler
 
 
 @contextmanager
@@ -33,4 +169,12 @@ def mktempfile():
             log.debug("No file {0}".format(name))
 
 
-
+def invoke_async(function, payload):
+    """Asynchronously invoke a lambda function with the given payload."""
+    import boto3
+    log.debug('Invoking function. Function: {0}'.format(function))
+    boto3.session.Session().client('lambda').invoke(
+        FunctionName=function,
+        InvocationType='Event',
+        Payload=json.dumps(payload).encode('utf-8')
+    )
@@ -48,6 +48,12 @@ setup(
     extras_require={
         'tests': tests_require
     },
+    entry_points={
+        'console_scripts': [
+            'spillguard-profile-terms = scumblr_spillguard.profiler:main',
+            'spillguard-backfill = scumblr_spillguard.backfill:main'
+        ]
+    },
     keywords=['github', 'secret_management'],
     classifiers=[
         'Programming Language :: Python',